@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+AWS-Backup-instances-benchmark.py - offline benchmark of the backup Lambda.
+
+It runs lambda_handler from AWS-Backup-instances.py against a synthetic fleet
+served by in-process stand-ins of the EC2, Auto Scaling and SNS clients, with
+simulated API latency and throttling. No AWS account is needed.
+
+Every scenario runs in its own process and reports wall time, API calls and
+throttles per operation, retries and peak memory. Results are written as JSON
+to --output.
+
+Usage: AWS-Backup-instances-benchmark.py [-s 10,100,5000] [-l 0.02] [-t 0.01]
+"""
+
+__author__ = "Lukasz Bytnar"
+__copyright__ = "Copyright 2018"
+__version__ = "0.0.1"
+__maintainer__ = "Lukasz Bytnar"
+__email__ = ""
+__status__ = "Development"
+
+import argparse
+import datetime
+import fnmatch
+import imp
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+HANDLER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'AWS-Backup-instances.py')
+
+PAGE_SIZE = 1000
+# Retries of throttled requests made by a botocore client (legacy mode).
+CLIENT_RETRIES = 4
+OK = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+class FakeAWS(object):
+    """
+    Shared state and accounting of the simulated AWS services.
+
+    Every request sleeps 'latency' seconds and is throttled with probability
+    'throttle_rate'. Like a botocore client, a throttled request is retried
+    up to CLIENT_RETRIES times with backoff (scaled by 'time_scale') before
+    the error reaches the caller. A new image exposes its snapshots
+    'ready_after' seconds after create_image.
+    """
+
+    def __init__(self, latency, throttle_rate, ready_after, time_scale):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.ready_after = ready_after
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.throttles = dict()
+        self.ids = itertools.count()
+        self.instances = []
+        self.images = dict()
+        self.snapshots = dict()
+        self.launch_images = set()
+
+    def call(self, operation):
+        """Account for one call of 'operation' and simulate its cost."""
+        for attempt in range(CLIENT_RETRIES + 1):
+            with self.lock:
+                self.calls[operation] = self.calls.get(operation, 0) + 1
+                throttled = random.random() < self.throttle_rate
+                if throttled:
+                    self.throttles[operation] = (
+                        self.throttles.get(operation, 0) + 1)
+            time.sleep(self.latency)
+            if not throttled:
+                return
+            time.sleep(random.uniform(0, 2 ** attempt) * self.time_scale)
+        raise ClientError({'Error': {'Code': 'RequestLimitExceeded',
+                                     'Message': 'Request limit exceeded.'}},
+                          operation)
+
+    def new_id(self, prefix):
+        """Return a new resource id."""
+        return '%s-%017x' % (prefix, next(self.ids))
+
+
+def make_fleet(aws, instances, images_per_instance, volumes):
+    """
+    Fill 'aws' with tagged instances and their daily backups.
+
+    Every instance has one backup per day for the last 'images_per_instance'
+    days, each with 'volumes' snapshots.
+    """
+    today = datetime.date.today()
+    for n in range(instances):
+        instance_id = aws.new_id('i')
+        name = 'host%05d' % n
+        aws.instances.append({
+            'InstanceId': instance_id,
+            'State': {'Name': 'running'},
+            'Tags': [{'Key': 'Name', 'Value': name},
+                     {'Key': 'Backup', 'Value': 'Yes'}],
+        })
+        for day in range(1, images_per_instance + 1):
+            created = today - datetime.timedelta(days=day)
+            image_id = aws.new_id('ami')
+            aws.images[image_id] = {
+                'ImageId': image_id,
+                'Name': '%s-%s' % (name, created.strftime('%s')),
+                'Public': False,
+                'State': 'available',
+                'CreationDate': created.isoformat() + 'T03:00:00.000Z',
+                'BlockDeviceMappings': [],
+            }
+            for v in range(volumes):
+                add_snapshot(aws, instance_id, image_id)
+
+
+def add_snapshot(aws, instance_id, image_id):
+    """Create a completed snapshot of 'image_id' and return its id."""
+    snapshot_id = aws.new_id('snap')
+    aws.snapshots[snapshot_id] = {
+        'SnapshotId': snapshot_id,
+        'State': 'completed',
+        'VolumeSize': 8,
+        'Description': 'Created by CreateImage(%s) for %s from %s' % (
+            instance_id, image_id, aws.new_id('vol')),
+    }
+    aws.images[image_id]['BlockDeviceMappings'].append(
+        {'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': snapshot_id}})
+    return snapshot_id
+
+
+def matches(item, filters, fields):
+    """Check 'item' against describe_* filters on the 'fields' map."""
+    for f in filters:
+        field = fields.get(f['Name'])
+        if field is None:
+            continue
+        if not any(fnmatch.fnmatchcase(str(item.get(field)), v)
+                   for v in f['Values']):
+            return False
+    return True
+
+
+class Paginator(object):
+    """Stand-in of a botocore paginator over a list of items."""
+
+    def __init__(self, aws, operation, key, items):
+        self.aws = aws
+        self.operation = operation
+        self.key = key
+        self.items = items
+
+    def paginate(self, **kwargs):
+        items = self.items(kwargs.get('Filters', []))
+        for pos in range(0, max(len(items), 1), PAGE_SIZE):
+            self.aws.call(self.operation)
+            yield {self.key: items[pos:pos + PAGE_SIZE]}
+
+
+class FakeEC2(object):
+    """Stand-in of the EC2 client used by the backup Lambda."""
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.meta = type('Meta', (object,), {'region_name': 'eu-west-1'})()
+
+    def get_paginator(self, operation):
+        aws = self.aws
+        if operation == 'describe_instances':
+            return Paginator(aws, operation, 'Reservations', lambda f: [
+                {'Instances': [i]} for i in aws.instances])
+        if operation == 'describe_images':
+            return Paginator(aws, operation, 'Images', lambda f: [
+                i for i in aws.images.values()
+                if i['State'] == 'available' and matches(
+                    i, f, {'creation-date': 'CreationDate'})])
+        if operation == 'describe_snapshots':
+            return Paginator(aws, operation, 'Snapshots', lambda f: [
+                s for s in aws.snapshots.values() if matches(
+                    s, f, {'description': 'Description'})])
+        raise NotImplementedError(operation)
+
+    def create_image(self, InstanceId, Name, Description, NoReboot,
+                     TagSpecifications=None):
+        self.aws.call('create_image')
+        image_id = self.aws.new_id('ami')
+        with self.aws.lock:
+            self.aws.images[image_id] = {
+                'ImageId': image_id,
+                'Name': Name,
+                'Public': False,
+                'State': 'pending',
+                'CreationDate': datetime.datetime.utcnow().isoformat() + 'Z',
+                'BlockDeviceMappings': [],
+                'ready_at': time.time() + self.aws.ready_after,
+                'instance_id': InstanceId,
+            }
+        return dict(OK, ImageId=image_id)
+
+    def describe_images(self, ImageIds=None, Owners=None, Filters=None):
+        self.aws.call('describe_images')
+        now = time.time()
+        images = []
+        with self.aws.lock:
+            if ImageIds is None:
+                # like EC2, an image-id filter skips unknown ids
+                ids = set(v for f in Filters or [] if f['Name'] == 'image-id'
+                          for v in f['Values'])
+                ImageIds = [i for i in self.aws.images if i in ids]
+            for image_id in ImageIds:
+                image = self.aws.images[image_id]
+                if image['State'] == 'pending' and now >= image['ready_at']:
+                    image['State'] = 'available'
+                    add_snapshot(self.aws, image['instance_id'], image_id)
+                images.append(image)
+        return {'Images': images}
+
+    def create_tags(self, Resources, Tags):
+        self.aws.call('create_tags')
+        return OK
+
+    def deregister_image(self, ImageId):
+        self.aws.call('deregister_image')
+        with self.aws.lock:
+            del self.aws.images[ImageId]
+        return OK
+
+    def delete_snapshot(self, SnapshotId):
+        self.aws.call('delete_snapshot')
+        with self.aws.lock:
+            del self.aws.snapshots[SnapshotId]
+        return OK
+
+
+class FakeAutoScaling(object):
+    """Stand-in of the Auto Scaling client used by the backup Lambda."""
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def describe_launch_configurations(self, LaunchConfigurationNames):
+        self.aws.call('describe_launch_configurations')
+        return {'LaunchConfigurations': [{
+            'LaunchConfigurationName': LaunchConfigurationNames[0],
+            'LaunchConfigurationARN': 'arn:aws:autoscaling:lc',
+            'ImageId': 'ami-0',
+            'InstanceType': 't2.micro',
+            'UserData': '',
+        }]}
+
+    def create_launch_configuration(self, **kwargs):
+        self.aws.call('create_launch_configuration')
+        with self.aws.lock:
+            self.aws.launch_images.add(kwargs['ImageId'])
+        return OK
+
+    def update_auto_scaling_group(self, **kwargs):
+        self.aws.call('update_auto_scaling_group')
+        return OK
+
+    def delete_launch_configuration(self, **kwargs):
+        self.aws.call('delete_launch_configuration')
+        return OK
+
+
+class FakeSNS(object):
+    """Stand-in of the SNS client used by the backup Lambda."""
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def publish(self, **kwargs):
+        self.aws.call('publish')
+        return OK
+
+
+def run_scenario(args):
+    """Run lambda_handler once against a fleet of 'args.single' instances."""
+    random.seed(args.seed)
+    aws = FakeAWS(args.latency, args.throttle_rate,
+                  args.ready_after * args.time_scale, args.time_scale)
+    make_fleet(aws, args.single, args.images, args.volumes)
+
+    handler = imp.load_source('backup_handler', HANDLER_PATH)
+    handler.ec2_connect = lambda region=None: FakeEC2(aws)
+    handler.asc_connect = lambda region=None: FakeAutoScaling(aws)
+    handler.sns_connect = lambda region=None: FakeSNS(aws)
+    handler.POLL_MIN_DELAY *= args.time_scale
+    handler.POLL_MAX_DELAY *= args.time_scale
+    handler.RETRY_BASE_DELAY *= args.time_scale
+    workdir = tempfile.mkdtemp()
+    handler.INDEX_PATH = os.path.join(workdir, 'index.sqlite')
+    handler.CHECKPOINT_BUCKET = None
+    handler.CHECKPOINT_PATH = os.path.join(workdir, 'checkpoint.json')
+
+    # the handler reports progress on stdout, which carries the result
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        status = handler.lambda_handler(None, None)
+        wall_time = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # every instance must have had its new AMI put in a Launch Configuration
+    launched = set(image['instance_id'] for image_id, image
+                   in aws.images.items()
+                   if 'instance_id' in image and
+                   image_id in aws.launch_images)
+    errors = []
+    if status is not None:
+        errors.append('lambda_handler returned %r' % (status,))
+    if len(launched) != args.single:
+        errors.append('%d of %d instances got a new Launch Configuration' % (
+            len(launched), args.single))
+
+    # ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result = {
+        'instances': args.single,
+        'images_per_instance': args.images,
+        'snapshots_per_image': args.volumes,
+        'latency': args.latency,
+        'throttle_rate': args.throttle_rate,
+        'status': status,
+        'launch_configurations': len(launched),
+        'wall_time': round(wall_time, 3),
+        'api_calls': aws.calls,
+        'total_api_calls': sum(aws.calls.values()),
+        'throttles': aws.throttles,
+        'retries': sum(aws.throttles.values()),
+        'peak_memory_bytes': peak,
+    }
+    if errors:
+        result['error'] = '; '.join(errors)
+    print json.dumps(result)
+    if errors:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark AWS-Backup-instances.py on a synthetic fleet.')
+    parser.add_argument('-s', '--scenarios', default='10,100,5000',
+                        help='comma separated fleet sizes')
+    parser.add_argument('-i', '--images', type=int, default=8,
+                        help='existing daily backups per instance')
+    parser.add_argument('-v', '--volumes', type=int, default=2,
+                        help='snapshots per backup')
+    parser.add_argument('-l', '--latency', type=float, default=0.02,
+                        help='simulated seconds per API call')
+    parser.add_argument('-t', '--throttle-rate', type=float, default=0.01,
+                        help='probability that an API call is throttled')
+    parser.add_argument('-r', '--ready-after', type=float, default=60,
+                        help='seconds until a new AMI exposes its snapshots')
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help='factor applied to poll, backoff and AMI delays')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', default='backup-benchmark.json',
+                        help='file to write the JSON results to')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        run_scenario(args)
+        return
+
+    results = []
+    for size in [int(s) for s in args.scenarios.split(',')]:
+        # a fresh process per scenario keeps peak memory figures apart
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--single', str(size)] + sys.argv[1:]
+        try:
+            output = subprocess.check_output(cmd)
+        except subprocess.CalledProcessError as e:
+            # a failed scenario still reports its figures when it got that far
+            try:
+                result = json.loads(e.output.splitlines()[-1])
+            except (IndexError, ValueError):
+                result = {'instances': size,
+                          'error': 'exit status %d' % e.returncode}
+            print "%6d instances: failed: %s" % (size, result['error'])
+            results.append(result)
+            continue
+        result = json.loads(output.splitlines()[-1])
+        print "%6d instances: %8.2fs, %6d API calls, %4d retries, %6.1f MiB" % (
+            size, result['wall_time'], result['total_api_calls'],
+            result['retries'], result['peak_memory_bytes'] / 2.0 ** 20)
+        results.append(result)
+
+    with open(args.output, 'w') as output:
+        json.dump({'generated_at': datetime.datetime.utcnow().isoformat(),
+                   'scenarios': results}, output, indent=2, sort_keys=True)
+
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
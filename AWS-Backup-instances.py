@@ -6,9 +6,13 @@ It creates image backup for instances. If corresponding Auto Scaling Group
 exists, it creates Launch Configuration with newly created AMI, replace LC at
 Autoscaling Group and remove old LC.
 
-It also cleans AMI and snapshots older than RETENTION.
+It also cleans AMI and snapshots older than RETENTION. Existing AMIs and
+snapshots are looked up in a local SQLite index (INDEX_PATH) that is refreshed
+incrementally on every run.
 
-Finally, if backups is successful, it sends SNS notification.
+All REGIONS are processed concurrently. A run that is about to hit the
+Lambda timeout saves a checkpoint and continues in a new invocation. Finally,
+it sends one SNS notification with the results of every region.
 """
 
 __author__ = "Lukasz Bytnar"
@@ -18,12 +22,24 @@ __maintainer__ = "Lukasz Bytnar"
 __email__ = ""
 __status__ = "Production"
 
-import boto3
-from botocore.exceptions import ClientError
+import time
+IMPORT_START = time.time()
+
+import contextlib
+import json
+import math
+import os
+import threading
+import sqlite3
+from botocore.exceptions import ClientError, ParamValidationError
 import datetime
+# strptime imports this lazily, which is not thread safe on Python 2
+import _strptime  # noqa: F401
 import re
 import base64
-import time
+import random
+import Queue
+from multiprocessing.pool import ThreadPool
 
 INSTANCE_FILTERS = [
    {'Name': 'tag:Backup', 'Values': ['Yes']}
@@ -31,6 +47,8 @@ INSTANCE_FILTERS = [
 
 OWNER_ID = ''
 REGION = 'eu-west-1'
+# Regions backed up by a run, unless the event lists 'regions'.
+REGIONS = os.environ.get('BACKUP_REGIONS', REGION).split(',')
 SNS_TOPIC = ''
 SNAPSHOT_DESC_PATTERN = re.compile(
     'Created by CreateImage\(i-[a-z0-9]{8,}\) for '
@@ -45,20 +63,249 @@ DESC_NAMES = {
 
 DATE_FORMAT = '%d-%m-%Y'
 
+# Number of instances that are backed up concurrently.
+MAX_WORKERS = 10
+
+# HTTP connections kept by each client: the pool workers plus the main thread.
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS',
+                                          MAX_WORKERS + 1))
+# Attempts of a call, including retries, made by the clients themselves.
+CLIENT_MAX_ATTEMPTS = 10
+
+# Seconds to wait for a new AMI and the bounds of the adaptive poll delay.
+IMAGE_TIMEOUT = 600
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+
+# Resources tagged by a single create_tags call.
+TAG_CHUNK_SIZE = 500
+
+# Errors meaning that create_image does not accept TagSpecifications.
+TAG_ON_CREATE_ERRORS = ('InvalidParameter', 'InvalidParameterValue',
+                        'UnknownParameter')
+
+# Retries of throttled API calls and the base of their backoff, in seconds.
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+
+THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+# Local index of backup images and snapshots, one file per region (suffixed
+# to INDEX_PATH). Use an EFS path to keep it between containers. It is
+# rebuilt from scratch after INDEX_MAX_AGE.
+INDEX_PATH = os.environ.get('BACKUP_INDEX', '/tmp/backup-index.sqlite')
+INDEX_MAX_AGE = datetime.timedelta(days=7)
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY, name TEXT NOT NULL, created_at DATE NOT NULL);
+CREATE INDEX IF NOT EXISTS images_name ON images (name, created_at);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY, ami_id TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS snapshots_ami ON snapshots (ami_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# Checkpoint of the current run, kept in S3 when CHECKPOINT_BUCKET is set.
+CHECKPOINT_BUCKET = os.environ.get('CHECKPOINT_BUCKET')
+CHECKPOINT_KEY = os.environ.get('CHECKPOINT_KEY', 'backup-checkpoint.json')
+CHECKPOINT_PATH = os.environ.get('CHECKPOINT_PATH',
+                                 '/tmp/backup-checkpoint.json')
+# Seconds between checkpoint writes while backups are finishing.
+CHECKPOINT_INTERVAL = 10
+# Seconds before the Lambda timeout at which the run stops and hands off.
+DEADLINE_MARGIN = 60
+MAX_CONTINUATIONS = 10
+
+# CloudWatch namespace of the metrics printed at the end of a run.
+METRICS_NAMESPACE = 'InstanceBackup'
+
+# Values passed in a single describe_* filter.
+FILTER_CHUNK_SIZE = 200
+
+
+def operation_key(model):
+    """Return the 'service.Operation' name of the operation 'model'."""
+    return '%s.%s' % (model.service_model.service_name, model.name)
+
+
+class Metrics(object):
+    """
+    API call and phase timings of a backup run.
+
+    Clients passed to instrument() report every operation through botocore
+    event hooks: calls, errors, retries, throttled attempts and latency.
+    Phase timings are recorded per instance (or 'run') with timer().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, cold_start=False):
+        """Forget everything recorded by the previous run."""
+        with self.lock:
+            self.cold_start = cold_start
+            self.operations = dict()
+            self.phases = dict()
+
+    def operation(self, model):
+        """Return stats of the operation, creating them on first use."""
+        return self.operation_stats(operation_key(model))
+
+    def operation_stats(self, key):
+        """Return stats of the operation 'key', creating them on first use."""
+        stats = self.operations.get(key)
+        if stats is None:
+            stats = self.operations.setdefault(key, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'throttles': 0,
+                'latency': []})
+        return stats
+
+    def before_call(self, model, context, **kwargs):
+        context['metrics_start'] = time.time()
+        # after-call-error comes without the model
+        context['metrics_operation'] = operation_key(model)
+
+    def after_call(self, model, context, parsed=None, **kwargs):
+        latency = time.time() - context.get('metrics_start', time.time())
+        parsed = parsed or {}
+        with self.lock:
+            stats = self.operation(model)
+            stats['calls'] += 1
+            stats['latency'].append(latency)
+            stats['retries'] += parsed.get(
+                'ResponseMetadata', {}).get('RetryAttempts', 0)
+            if 'Error' in parsed:
+                stats['errors'] += 1
+
+    def after_call_error(self, context, exception=None, **kwargs):
+        latency = time.time() - context.get('metrics_start', time.time())
+        with self.lock:
+            stats = self.operation_stats(
+                context.get('metrics_operation', 'unknown'))
+            stats['calls'] += 1
+            stats['errors'] += 1
+            stats['latency'].append(latency)
+
+    def needs_retry(self, operation, response=None, **kwargs):
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLE_ERRORS:
+            with self.lock:
+                self.operation(operation)['throttles'] += 1
+        # never decide on the retry, botocore's own handler does
+        return None
+
+    def instrument(self, client):
+        """Register hooks on the boto3 'client' and return it."""
+        events = client.meta.events
+        events.register('before-call', self.before_call)
+        events.register('after-call', self.after_call)
+        events.register('after-call-error', self.after_call_error)
+        events.register('needs-retry', self.needs_retry)
+        return client
+
+    def phase(self, name, phase, seconds):
+        """Record 'seconds' spent by 'name' instance in 'phase'."""
+        with self.lock:
+            phases = self.phases.setdefault(name, dict())
+            phases[phase] = phases.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, phase):
+        """Record the time spent in the block as 'phase' of 'name'."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase(name, phase, time.time() - start)
+
+    def summary(self):
+        """Return the run summary with latency percentiles in ms."""
+        operations = dict()
+        for key, stats in self.operations.items():
+            latency = sorted(stats['latency'])
+            summary = dict((k, v) for k, v in stats.items() if k != 'latency')
+            summary['latency_ms'] = dict(
+                ('p%d' % p, round(percentile(latency, p) * 1000, 1))
+                for p in (50, 90, 99, 100))
+            operations[key] = summary
+        phases = dict((name, dict((k, round(v, 3)) for k, v in p.items()))
+                      for name, p in self.phases.items())
+        return {'cold_start': self.cold_start, 'operations': operations,
+                'phases': phases}
+
+    def emit(self):
+        """
+        Print the run summary as one JSON line, followed by one CloudWatch
+        embedded metric format line per operation.
+        """
+        summary = self.summary()
+        print(json.dumps({'backup_metrics': summary}, sort_keys=True))
+        timestamp = int(time.time() * 1000)
+        for key, stats in sorted(summary['operations'].items()):
+            metrics = [('Calls', 'Count', stats['calls']),
+                       ('Errors', 'Count', stats['errors']),
+                       ('Retries', 'Count', stats['retries']),
+                       ('Throttles', 'Count', stats['throttles'])] + [
+                      ('Latency' + p.upper(), 'Milliseconds', v)
+                      for p, v in stats['latency_ms'].items()]
+            line = {'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Operation']],
+                'Metrics': [{'Name': n, 'Unit': u} for n, u, _ in metrics]
+            }]}, 'Operation': key}
+            line.update((n, v) for n, _, v in metrics)
+            print(json.dumps(line, sort_keys=True))
+
+
+def percentile(values, p):
+    """Return the nearest-rank 'p' percentile of sorted 'values'."""
+    if not values:
+        return 0
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+METRICS = Metrics()
+
+# Clients are created on first use and reused by warm invocations.
+CLIENTS = dict()
+CLIENTS_LOCK = threading.Lock()
+
 
-def ec2_connect():
+def get_client(service, region=None):
+    """Return the cached, instrumented boto3 client for 'service'."""
+    client = CLIENTS.get((service, region))
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get((service, region))
+            if client is None:
+                # boto3 is imported on first use, it dominates import time
+                import boto3
+                from botocore.config import Config
+                config = Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                retries={'mode': 'adaptive',
+                                         'max_attempts': CLIENT_MAX_ATTEMPTS})
+                client = METRICS.instrument(boto3.client(
+                    service, region_name=region, config=config))
+                CLIENTS[(service, region)] = client
+    return client
+
+
+def ec2_connect(region=None):
     """Return connection object for ec2."""
-    return boto3.client('ec2')
+    return get_client('ec2', region)
 
 
-def asc_connect():
+def asc_connect(region=None):
     """Return connection object for autoscaling."""
-    return boto3.client('autoscaling')
+    return get_client('autoscaling', region)
 
 
-def sns_connect():
+def sns_connect(region=None):
     """Return connection objcet for Simple Notification Service."""
-    return boto3.client('sns')
+    return get_client('sns', region)
 
 
 def get_tag(instance, tag_name):
@@ -72,63 +319,174 @@ def get_tag(instance, tag_name):
     )
 
 
+def paginate(ec2, operation, key, **kwargs):
+    """Yield items stored under 'key' from every page of 'operation'."""
+    paginator = ec2.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        for item in page.get(key, []):
+            yield item
+
+
 def get_instances(ec2):
-    """Return instances after applying filter."""
-    reservations = ec2.describe_instances(
-      Filters=INSTANCE_FILTERS).get('Reservations', [])
-    instances = sum(
-        [
-            [i for i in r['Instances']]
-            for r in reservations
-        ], [])
-    return instances
-
-
-def tag_resources(ec2, resource_id, label):
-    """Add tag to resource."""
-    ec2.create_tags(
-        Resources=(resource_id,),
-        Tags=[
-            {'Key': 'Name', 'Value': label},
-        ])
-    print "Creating tag for resource_id %s with Name:%s label!" % (resource_id,
-                                                                   label)
-
-
-def get_snapshots(ec2):
-    """Return list of ami_id with the corresponding snapshots."""
-    response = ec2.describe_snapshots(OwnerIds=[OWNER_ID], MaxResults=1000,
-                                      Filters=[
-                                      {'Name': 'status',
-                                       'Values': ['completed']}
-                                      ])['Snapshots']
-
-    all_snapshots = dict()
-    for s in response:
-        snapshot_id = s['SnapshotId']
-        snapshot_desc = s['Description']
-        m = SNAPSHOT_DESC_PATTERN.match(snapshot_desc)
-        if m is None:
-            pass
-        else:
-            ami_id = m.group(1)
-            if ami_id not in all_snapshots:
-                all_snapshots[ami_id] = []
-            all_snapshots[ami_id].append(snapshot_id)
-    return all_snapshots
+    """Yield instances after applying filter, page by page."""
+    for r in paginate(ec2, 'describe_instances', 'Reservations',
+                      Filters=INSTANCE_FILTERS):
+        for i in r['Instances']:
+            yield i
+
+
+def name_tags(label):
+    """Return the Name tag list for 'label'."""
+    return [{'Key': 'Name', 'Value': label}]
+
+
+def tag_resources(ec2, labels):
+    """
+    Add Name tags to resources, given as a map of label -> resource ids.
+
+    Resources sharing a label are tagged together, TAG_CHUNK_SIZE at a time.
+    """
+    for label, resource_ids in labels.items():
+        for pos in range(0, len(resource_ids), TAG_CHUNK_SIZE):
+            chunk = resource_ids[pos:pos + TAG_CHUNK_SIZE]
+            ec2.create_tags(Resources=chunk, Tags=name_tags(label))
+            print "Creating tag for %d resources with Name:%s label!" % (
+                len(chunk), label)
+
+
+def iter_snapshots(ec2, filters=()):
+    """Yield completed snapshots owned by OWNER_ID, page by page."""
+    return paginate(ec2, 'describe_snapshots', 'Snapshots',
+                    OwnerIds=[OWNER_ID],
+                    Filters=[{'Name': 'status', 'Values': ['completed']}] +
+                    list(filters),
+                    PaginationConfig={'PageSize': 1000})
 
 
-def remove_backup(ec2, image_id, snapshots):
-    """Remove 'image_id' AMI and all snapshots (that belongs to AMI)."""
+def parse_snapshot(s):
+    """
+    Return (snapshot_id, ami_id, size) of a snapshot created for an AMI.
+
+    Size is the volume size in GiB. Return None for any other snapshot.
+    """
+    m = SNAPSHOT_DESC_PATTERN.match(s['Description'])
+    if m is None:
+        return None
+    return s['SnapshotId'], m.group(1), s.get('VolumeSize', 0)
+
+
+def call_with_backoff(func, **kwargs):
+    """
+    Call an EC2 API function, retrying when requests are throttled.
+
+    The delay doubles from RETRY_BASE_DELAY with full jitter, for at most
+    MAX_RETRIES retries.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if not is_throttled(e) or attempt == MAX_RETRIES:
+                raise
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def remove_image(ec2, image_id):
+    """Deregister 'image_id' AMI, an already removed AMI is not an error."""
     print("- Remove AMI %s " % image_id)
-    ec2.deregister_image(ImageId=image_id)
-    for s in snapshots:
-        print("- Remove snapshot %s" % s)
-        ec2.delete_snapshot(SnapshotId=s)
+    try:
+        call_with_backoff(ec2.deregister_image, ImageId=image_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('InvalidAMIID.NotFound',
+                                               'InvalidAMIID.Unavailable'):
+            raise
+        return False
+    return True
+
+
+def remove_snapshot(ec2, snapshot_id):
+    """Delete 'snapshot_id', an already removed snapshot is not an error."""
+    print("- Remove snapshot %s" % snapshot_id)
+    try:
+        call_with_backoff(ec2.delete_snapshot, SnapshotId=snapshot_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidSnapshot.NotFound':
+            raise
+        return False
+    return True
+
+
+def remove_backups(ec2, expired):
+    """
+    Remove expired backups, given as a list of (image_id, snapshots) pairs.
+
+    All AMIs are deregistered first, then the snapshots of the deregistered
+    AMIs are deleted, both by a pool of MAX_WORKERS threads. An AMI without
+    indexed snapshots is only deregistered.
+
+    Return a report with the number of removed images and snapshots, the
+    reclaimed bytes (by snapshot volume size), the ids of all resources that
+    are gone, the number of those that were already missing and the failures.
+    """
+    report = {'images': 0, 'snapshots': 0, 'bytes': 0, 'removed': [],
+              'missing': 0, 'failures': []}
+    if not expired:
+        return report
 
+    pool = ThreadPool(MAX_WORKERS)
+    try:
+        results = pool.map(
+            lambda pair: call_safely(remove_image, ec2, pair[0]), expired)
+
+        snapshots = []
+        for (image_id, image_snapshots), (ok, err) in zip(expired, results):
+            if err is not None:
+                report['failures'].append((image_id, err))
+                continue
+            report['removed'].append(image_id)
+            if ok:
+                report['images'] += 1
+            else:
+                report['missing'] += 1
+            snapshots.extend(image_snapshots)
+
+        results = pool.map(
+            lambda snap: call_safely(remove_snapshot, ec2, snap['id']),
+            snapshots)
+
+        for snap, (ok, err) in zip(snapshots, results):
+            if err is not None:
+                report['failures'].append((snap['id'], err))
+                continue
+            report['removed'].append(snap['id'])
+            if ok:
+                report['snapshots'] += 1
+                report['bytes'] += snap['size'] * 2 ** 30
+            else:
+                report['missing'] += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    return report
+
+
+def call_safely(func, *args):
+    """Return (func(*args), None), or (None, error) if the call raised."""
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, e
+
+
+def start_backup(ec2, instance, name):
+    """
+    Call create_image for the instance without a reboot.
 
-def backup_instance(ec2, instance, name):
-    """Create AMI of the instance without a reboot."""
+    The AMI and its snapshots are tagged on create when the API accepts
+    TagSpecifications. Return (image_id, ami_desc, tagged), or None if the
+    image was not created.
+    """
     state = instance['State']['Name']
 
     today_epoch_time = datetime.date.today().strftime('%s')
@@ -145,68 +503,339 @@ def backup_instance(ec2, instance, name):
     noreboot = state == 'running'
     print("+ Call create_image, Name=%s, Desc=%s, NoReboot=%s" %
           (ami_name, ami_desc, noreboot))
+    params = dict(InstanceId=instance['InstanceId'], Name=ami_name,
+                  Description=ami_desc, NoReboot=noreboot)
+    tag_spec = [{'ResourceType': r, 'Tags': name_tags(ami_desc)}
+                for r in ('image', 'snapshot')]
     try:
-        image = ec2.create_image(InstanceId=instance['InstanceId'],
-                                 Name=ami_name, Description=ami_desc,
-                                 NoReboot=noreboot)
+        try:
+            image = ec2.create_image(TagSpecifications=tag_spec, **params)
+            tagged = True
+        except ParamValidationError:
+            # botocore predates tag-on-create for images
+            image = ec2.create_image(**params)
+            tagged = False
+        except ClientError as e:
+            if e.response['Error']['Code'] not in TAG_ON_CREATE_ERRORS:
+                raise
+            image = ec2.create_image(**params)
+            tagged = False
     except ClientError as e:
         if e.response['Error']['Code'] == 'InvalidAMIName.Duplicate':
             print("  => " + e.response['Error']['Message'])
-            return False
+            return None
+        raise
 
     img_response_code = image['ResponseMetadata']['HTTPStatusCode']
     print("+ EC2 response: HTTPStatusCode %s" % img_response_code)
-    if img_response_code != 200:
-        return -1
+    if img_response_code != 200 or not image['ImageId']:
+        return None
+
+    return image['ImageId'], ami_desc, tagged
+
+
+def is_throttled(error):
+    """Check if ClientError means that EC2 API requests were throttled."""
+    return error.response['Error']['Code'] in THROTTLE_ERRORS
+
+
+def track_images(ec2, image_ids, stop_at=None):
+    """
+    Track pending images with one batched describe_images call per tick.
+
+    Yield (image_id, snapshots) as soon as an image exposes its snapshots, or
+    (image_id, None) if the image failed or missed its IMAGE_TIMEOUT deadline.
+    The poll delay doubles up to POLL_MAX_DELAY while nothing changes, and is
+    reset to POLL_MIN_DELAY whenever an image becomes ready. Tracking stops,
+    leaving the remaining images pending, when the next poll would end after
+    'stop_at'.
+    """
+    deadline = time.time() + IMAGE_TIMEOUT
+    pending = dict((image_id, deadline) for image_id in image_ids)
+    delay = POLL_MIN_DELAY
+    while pending:
+        if stop_at is not None and time.time() + delay > stop_at:
+            print("Out of time, %d image(s) left pending" % len(pending))
+            return
+        print("Waiting for %d image(s) to become available" % len(pending))
+        # equal jitter keeps concurrent runs from polling in lockstep
+        time.sleep(delay / 2.0 + random.uniform(0, delay / 2.0))
+
+        # unlike ImageIds, a filter does not fail the whole batch on an id
+        # that is not visible yet, or not anymore
+        image_ids = list(pending)
+        images = []
+        try:
+            for pos in range(0, len(image_ids), FILTER_CHUNK_SIZE):
+                images.extend(ec2.describe_images(Owners=['self'], Filters=[
+                    {'Name': 'image-id',
+                     'Values': image_ids[pos:pos + FILTER_CHUNK_SIZE]}])[
+                        'Images'])
+        except ClientError as e:
+            if not is_throttled(e):
+                raise
+
+        progressed = False
+        for image in images:
+            image_id = image['ImageId']
+            if image_id not in pending:
+                continue
+            snapshots = [s['Ebs']['SnapshotId']
+                         for s in image.get('BlockDeviceMappings', [])
+                         if 'SnapshotId' in s.get('Ebs', {})]
+            if snapshots:
+                del pending[image_id]
+                progressed = True
+                yield image_id, snapshots
+            elif image['State'] in ('failed', 'error', 'invalid',
+                                    'deregistered'):
+                del pending[image_id]
+                yield image_id, None
+
+        now = time.time()
+        for image_id, image_deadline in list(pending.items()):
+            if now > image_deadline:
+                print("  => Timed out waiting for " + image_id)
+                del pending[image_id]
+                yield image_id, None
+
+        if progressed:
+            delay = POLL_MIN_DELAY
+        else:
+            delay = min(delay * 2, POLL_MAX_DELAY)
+
+
+def finish_backup(asc, name, image_id):
+    """
+    Swap the new AMI into the Launch Configuration.
 
-    if(image['ImageId']):
-        print("Waiting for image to become available: " + image['ImageId'])
-        # waiter = ec2.get_waiter('image_available')
-        # waiter.wait(ImageIds=[image['ImageId']])
-        snaps = []
-        while snaps == []:
-            time.sleep(5)
-            snaps = ec2.describe_images(Owners=['self'], Filters=[
-                                        {'Name': 'image-id',
-                                         'Values': [image['ImageId']]}
-                                        ])['Images'][0]['BlockDeviceMappings']
-        for s in snaps:
-            tag_resources(ec2, s['Ebs']['SnapshotId'], ami_desc)
-        tag_resources(ec2, image['ImageId'], ami_desc)
-    return image['ImageId']
-
-
-def get_images(ec2):
+    Return True if the backup of the instance is complete.
     """
-    The function collects a map of all existing private images by name.
+    day_ago = (datetime.date.today() -
+               datetime.timedelta(days=1)).strftime(DATE_FORMAT)
+    lc_name_updated = update_launch_configuration(
+            asc, name + '-lc ' + day_ago, image_id)
+    if lc_name_updated == -1:
+        return False
 
-    Return the list of images.
+    if update_autoscaling_group(asc, name + '-asg', lc_name_updated):
+        return False
+
+    delete_launch_configuration(asc, name + '-lc ' + day_ago)
+    return True
+
+
+def backup_instances(ec2, asc, jobs, checkpoint, resumed=None,
+                     stop_at=None):
     """
-    response = ec2.describe_images(Owners=['self'], Filters=[
-        {'Name': 'image-type', 'Values': ['machine']},
-        {'Name': 'root-device-type', 'Values': ['ebs']},
-        {'Name': 'state', 'Values': ['available']}
-    ])['Images']
-
-    all_images = dict()
-    for i in response:
-        if not i['Public']:  # skip public images
-            name = i['Name']
-            image_id = i['ImageId']
-            created_at = datetime.datetime.strptime(
-                i['CreationDate'].split('T')[0], "%Y-%m-%d"
-            ).date()
-
-            pos = name.rfind('-')
-            if pos > 0 and name[pos + 1:].isdigit():  # basic checks
-                name = name[0:pos]
-                if name not in all_images:
-                    all_images[name] = []
-                all_images[name].append(
-                    {'id': image_id, 'created_at': created_at}
-                )
-
-    return all_images
+    Back up every (instance, name) pair of 'jobs' concurrently.
+
+    All create_image calls are issued at once by a pool of MAX_WORKERS
+    threads and the pending images are awaited together, along with the
+    'resumed' images (image_id -> (name, ami_desc, tagged)) created by an
+    earlier invocation. Yield (name, ok) for every instance as soon as its
+    backup is finished, so one failing instance does not stop the others.
+
+    New images are recorded in 'checkpoint'. Past 'stop_at' no backup is
+    started and tracking stops; the instances left are not yielded.
+    """
+    region = ec2.meta.region_name
+    pool = ThreadPool(MAX_WORKERS)
+    try:
+        created = dict()
+
+        def start(job):
+            if stop_at is not None and time.time() > stop_at:
+                return None  # left for the next invocation
+            with METRICS.timer(region + '/' + job[1], 'create_image'):
+                res, err = call_safely(start_backup, ec2, *job)
+            if res is not None:
+                created[res[0]] = time.time()
+                checkpoint.started(region, job[1], res)
+            return res, err
+
+        started = pool.map(start, jobs)
+
+        pending = dict()
+        for image_id, image in (resumed or {}).items():
+            created[image_id] = time.time()
+            pending[image_id] = tuple(image)
+        for (instance, name), result in zip(jobs, started):
+            if result is None:
+                continue
+            res, err = result
+            if res is None:
+                print("  => Backup of %s (%s) failed: %s" %
+                      (name, instance['InstanceId'], err or 'no image'))
+                yield name, False
+            else:
+                pending[res[0]] = (name, res[1], res[2])
+
+        def finish(image_id):
+            name = pending[image_id][0]
+            with METRICS.timer(region + '/' + name, 'finish'):
+                return name, image_id, call_safely(
+                    finish_backup, asc, name, image_id)
+
+        def report(result):
+            name, image_id, (ok, err) = result
+            if ok:
+                print("  => Backup of %s completed: %s" % (name, image_id))
+            else:
+                print("  => Backup of %s (%s) failed: %s" %
+                      (name, image_id, err or 'LC swap failed'))
+            return name, bool(ok)
+
+        # finish every image as soon as it is ready, not after the slowest
+        done = Queue.Queue()
+        submitted = 0
+        untagged = dict()
+        for image_id, snapshots in track_images(ec2, pending.keys(),
+                                                stop_at):
+            name, ami_desc, tagged = pending[image_id]
+            METRICS.phase(region + '/' + name, 'wait_image',
+                          time.time() - created[image_id])
+            if snapshots is None:
+                print("  => Backup of %s failed: %s is not available" %
+                      (name, image_id))
+                yield name, False
+            else:
+                if not tagged:
+                    untagged.setdefault(ami_desc, []).extend(
+                        [image_id] + snapshots)
+                pool.apply_async(finish, (image_id,), callback=done.put)
+                submitted += 1
+            while not done.empty():
+                submitted -= 1
+                yield report(done.get())
+
+        # images created without TagSpecifications are tagged in bulk
+        tag_resources(ec2, untagged)
+
+        for _ in range(submitted):
+            yield report(done.get())
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_images(ec2, filters=()):
+    """Yield available private EBS machine images, page by page."""
+    return paginate(ec2, 'describe_images', 'Images', Owners=['self'],
+                    Filters=[
+                        {'Name': 'image-type', 'Values': ['machine']},
+                        {'Name': 'root-device-type', 'Values': ['ebs']},
+                        {'Name': 'state', 'Values': ['available']}
+                    ] + list(filters))
+
+
+def parse_image(i):
+    """
+    Return (image_id, name, created_at) of a backup image.
+
+    Name is the instance name, without the '-<epoch>' suffix. Return None for
+    public images and images that are not named like backups.
+    """
+    if i['Public']:  # skip public images
+        return None
+    name = i['Name']
+    pos = name.rfind('-')
+    if pos <= 0 or not name[pos + 1:].isdigit():  # basic checks
+        return None
+    created_at = datetime.datetime.strptime(
+        i['CreationDate'].split('T')[0], "%Y-%m-%d"
+    ).date()
+    return i['ImageId'], name[0:pos], created_at
+
+
+def open_index(path):
+    """Open (or create) the local index of backup images and snapshots."""
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    db.executescript(INDEX_SCHEMA)
+    return db
+
+
+def get_meta(db, key):
+    """Return 'key' value stored in the index, or None."""
+    row = db.execute('SELECT value FROM meta WHERE key = ?',
+                     (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(db, key, value):
+    """Store 'key' value in the index."""
+    db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+
+def index_resources(db, images=(), snapshots=()):
+    """Add images and snapshots, as returned by EC2, to the index."""
+    db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?)',
+                   (r for r in (parse_image(i) for i in images) if r))
+    db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)',
+                   (r for r in (parse_snapshot(s) for s in snapshots) if r))
+
+
+def forget_resources(db, resource_ids):
+    """Remove images and snapshots with 'resource_ids' from the index."""
+    rows = [(r,) for r in resource_ids]
+    with db:
+        db.executemany('DELETE FROM images WHERE id = ?', rows)
+        db.executemany('DELETE FROM snapshots WHERE id = ?', rows)
+
+
+def refresh_index(ec2, db):
+    """
+    Bring the index up to date with EC2.
+
+    Images created since the day of the last sync are fetched with a
+    creation-date filter, and only the snapshots of those images are fetched
+    by their description. The index is rebuilt from scratch when it is new,
+    older than INDEX_MAX_AGE, built for another account or region, or
+    marked stale after a cleanup found resources it did not expect.
+    """
+    today = datetime.date.today()
+    scope = '%s/%s' % (OWNER_ID, ec2.meta.region_name)
+    synced = get_meta(db, 'synced')
+    if synced is not None:
+        synced = datetime.datetime.strptime(synced, '%Y-%m-%d').date()
+
+    with db:
+        if (synced is None or today - synced > INDEX_MAX_AGE or
+                get_meta(db, 'scope') != scope or get_meta(db, 'stale')):
+            print("Rebuilding backup index")
+            db.execute('DELETE FROM images')
+            db.execute('DELETE FROM snapshots')
+            index_resources(db, iter_images(ec2), iter_snapshots(ec2))
+            set_meta(db, 'scope', scope)
+            set_meta(db, 'stale', None)
+        else:
+            days = ['%s*' % (synced + datetime.timedelta(days=d)).isoformat()
+                    for d in range((today - synced).days + 1)]
+            images = list(iter_images(
+                ec2, [{'Name': 'creation-date', 'Values': days}]))
+            print("Refreshing backup index, %d new images" % len(images))
+            index_resources(db, images)
+
+            image_ids = [i['ImageId'] for i in images]
+            for pos in range(0, len(image_ids), FILTER_CHUNK_SIZE):
+                desc = ['Created by CreateImage(*) for %s from *' % i
+                        for i in image_ids[pos:pos + FILTER_CHUNK_SIZE]]
+                index_resources(db, snapshots=iter_snapshots(
+                    ec2, [{'Name': 'description', 'Values': desc}]))
+        set_meta(db, 'synced', today.isoformat())
+
+
+def index_images(db, name):
+    """Return backup images of the 'name' instance, oldest first."""
+    return [{'id': r[0], 'created_at': r[1]} for r in db.execute(
+        'SELECT id, created_at FROM images WHERE name = ? '
+        'ORDER BY created_at', (name,))]
+
+
+def index_snapshots(db, image_id):
+    """Return snapshots that belong to 'image_id' AMI."""
+    return [{'id': r[0], 'size': r[1]} for r in db.execute(
+        'SELECT id, size FROM snapshots WHERE ami_id = ?', (image_id,))]
 
 
 def update_autoscaling_group(asc, asg_name, lc_name):
@@ -269,26 +898,53 @@ def update_launch_configuration(asc, lc_name, ami_id):
         return -1
 
 
-def lambda_handler(event, context):
-    """Handler for a lambda funcion."""
-    ec2 = ec2_connect()
-    asc = asc_connect()
-    sns = sns_connect()
+def backup_region(region, checkpoint, stop_at=None):
+    """
+    Back up tagged instances of 'region' and remove their expired backups.
+
+    Progress is kept in 'checkpoint': instances finished by an earlier
+    invocation are skipped and their pending images are tracked again.
+    Backups that could not be finished before 'stop_at' are left for the
+    next invocation, and so is the cleanup.
+
+    Return the region report with names of backed up and failed instances,
+    the cleanup report and whether the region is complete.
+    """
+    state = checkpoint.region(region)
+    if state['cleanup'] is not None:
+        return region_report(region, state)
+
+    with METRICS.timer(region, 'setup'):
+        ec2 = ec2_connect(region)
+        asc = asc_connect(region)
 
-    all_images = get_images(ec2)
-    all_snapshots = get_snapshots(ec2)
-    instances = get_instances(ec2)
+    db = open_index(index_path(region))
+    with METRICS.timer(region, 'refresh_index'):
+        refresh_index(ec2, db)
 
     today = datetime.date.today()
-    day_ago = (today - datetime.timedelta(days=1)).strftime(DATE_FORMAT)
 
-    for i in instances:
+    jobs = []
+    resumed = dict()
+    retained = dict()
+    for i in get_instances(ec2):
         name = get_tag(i, 'Name')
 
-        print('Instance %s, status: %s' % (name, i['State']['Name']))
-        if name in all_images:
-            images = all_images[name]
-            images.sort(key=lambda r: r['created_at'])
+        if name in state['done']:
+            if state['done'][name]:
+                retained[name] = index_images(db, name)
+            continue
+        if name in state['pending']:
+            print("  => Resume backup of %s" % name)
+            image = state['pending'][name]
+            resumed[image[0]] = [name] + image[1:]
+            retained[name] = index_images(db, name)
+            continue
+
+        print('%s: instance %s, status: %s' % (region, name,
+                                               i['State']['Name']))
+        images = index_images(db, name)
+        if images:
             dates = [r['created_at'] for r in images]
             print("%d images since %s till %s" % (
                 len(dates), dates[0].isoformat(), dates[-1].isoformat()))
@@ -301,29 +957,281 @@ def lambda_handler(event, context):
             print("  => Skip %s (%s) - a fresh backup already exists" %
                   (name, i['InstanceId']))
         else:
-            ami_id = backup_instance(ec2, i, name)
-            lc_name_updated = update_launch_configuration(
-                    asc, name + '-lc ' + day_ago, ami_id)
-            if lc_name_updated != -1:
-                res = update_autoscaling_group(asc, name + '-asg',
-                                               lc_name_updated)
-                if not res:
-                    delete_launch_configuration(asc, name + '-lc ' + day_ago)
-                    # Send notification that backup was completed.
-                    sns.publish(
-                        TopicArn=SNS_TOPIC,
-                        Subject=name + ' Daily Backup',
-                        Message=name + ' backup completed successfully.'
-                    )
-                else:
-                    return 1
+            jobs.append((i, name))
+        retained[name] = images
+
+    with METRICS.timer(region, 'backup'):
+        for name, ok in backup_instances(ec2, asc, jobs, checkpoint,
+                                         resumed, stop_at):
+            checkpoint.finished(region, name, ok)
+            if not ok:
+                # Keep old backups of instances that could not be backed up.
+                retained.pop(name, None)
+
+    left = [name for name in [job[1] for job in jobs] +
+            [image[0] for image in resumed.values()]
+            if name not in state['done']]
+    if left or (stop_at is not None and time.time() > stop_at):
+        print("%s: %d backups left for the next invocation" % (
+            region, len(left)))
+        db.close()
+        return region_report(region, state)
+
+    # Remove old Backups
+    expired = [(img['id'], index_snapshots(db, img['id']))
+               for images in retained.values()
+               for img in images
+               if today - img['created_at'] > RETENTION]
+    with METRICS.timer(region, 'cleanup'):
+        report = remove_backups(ec2, expired)
+    print("%s: removed %d AMIs and %d snapshots, %.1f GiB reclaimed" % (
+        region, report['images'], report['snapshots'],
+        report['bytes'] / 2.0 ** 30))
+    for resource_id, err in report['failures']:
+        print("  => Failed to remove %s: %s" % (resource_id, err))
+
+    forget_resources(db, report['removed'])
+    if report['missing']:
+        # someone else removed indexed backups, rebuild on the next run
+        with db:
+            set_meta(db, 'stale', '1')
+    db.close()
+
+    checkpoint.cleaned(region, report)
+    return region_report(region, state)
+
+
+def region_report(region, state):
+    """Return the report of 'region' from its checkpoint state."""
+    cleanup = state['cleanup'] or {'images': 0, 'snapshots': 0, 'bytes': 0,
+                                   'failures': []}
+    return {'region': region,
+            'completed': sorted(n for n, ok in state['done'].items() if ok),
+            'failed': sorted(n for n, ok in state['done'].items() if not ok),
+            'cleanup': cleanup,
+            'complete': state['cleanup'] is not None}
+
+
+class Checkpoint(object):
+    """
+    Progress of a backup run, so that a stopped run resumes where it left.
+
+    The checkpoint of run 'run' is kept as JSON in the CHECKPOINT_BUCKET S3
+    bucket, or in the CHECKPOINT_PATH file when no bucket is set. For every
+    region it holds the images created but not finished yet, the finished
+    instances and the cleanup report once the cleanup is done. Changes are
+    written at most every CHECKPOINT_INTERVAL seconds, unless forced.
+    """
+
+    def __init__(self, run, regions=None):
+        self.run = run
+        self.regions = regions or dict()
+        self.lock = threading.Lock()
+        self.saved_at = time.time()
+
+    @classmethod
+    def load(cls, run):
+        """Return the stored checkpoint of 'run', or a new one."""
+        try:
+            if CHECKPOINT_BUCKET:
+                body = get_client('s3').get_object(
+                    Bucket=CHECKPOINT_BUCKET, Key=CHECKPOINT_KEY)['Body']
+                data = json.loads(body.read())
             else:
-                return 1
+                with open(CHECKPOINT_PATH) as f:
+                    data = json.load(f)
+        except (IOError, ValueError):
+            return cls(run)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return cls(run)
+        if data.get('run') != run:
+            return cls(run)
+        print("Resuming backup run %s" % run)
+        return cls(run, data['regions'])
+
+    def region(self, region):
+        """Return the state of 'region'."""
+        with self.lock:
+            return self.regions.setdefault(
+                region, {'pending': {}, 'done': {}, 'cleanup': None})
+
+    def started(self, region, name, image):
+        """Record that 'image' (image_id, ami_desc, tagged) was created."""
+        with self.lock:
+            self.regions[region]['pending'][name] = list(image)
+        self.save(force=False)
+
+    def finished(self, region, name, ok):
+        """Record that the backup of 'name' is finished."""
+        with self.lock:
+            state = self.regions[region]
+            state['pending'].pop(name, None)
+            state['done'][name] = ok
+        self.save(force=False)
+
+    def cleaned(self, region, report):
+        """Record the cleanup report of 'region'."""
+        with self.lock:
+            self.regions[region]['cleanup'] = {
+                'images': report['images'],
+                'snapshots': report['snapshots'],
+                'bytes': report['bytes'],
+                'failures': [(r, str(e)) for r, e in report['failures']]}
+        self.save()
+
+    def save(self, force=True):
+        """Write the checkpoint."""
+        with self.lock:
+            if not force and time.time() - self.saved_at < CHECKPOINT_INTERVAL:
+                return
+            data = json.dumps({'run': self.run, 'regions': self.regions})
+            self.saved_at = time.time()
+        if CHECKPOINT_BUCKET:
+            get_client('s3').put_object(Bucket=CHECKPOINT_BUCKET,
+                                        Key=CHECKPOINT_KEY, Body=data)
+        else:
+            with open(CHECKPOINT_PATH + '.tmp', 'w') as f:
+                f.write(data)
+            os.rename(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+    def clear(self):
+        """Remove the checkpoint of a finished run."""
+        if CHECKPOINT_BUCKET:
+            get_client('s3').delete_object(Bucket=CHECKPOINT_BUCKET,
+                                           Key=CHECKPOINT_KEY)
+        elif os.path.exists(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
+
+
+def continue_run(event, context, run):
+    """
+    Invoke the function again, asynchronously, to continue 'run'.
+
+    At most MAX_CONTINUATIONS invocations are chained, and only with the
+    checkpoint in CHECKPOINT_BUCKET: the new invocation may run in another
+    container, which does not have the CHECKPOINT_PATH file.
+    """
+    continuations = event.get('continuations', 0)
+    if context is not None and not CHECKPOINT_BUCKET:
+        print("Run %s is not finished, set CHECKPOINT_BUCKET to continue it "
+              "in a new invocation" % run)
+        return
+    if context is None or continuations >= MAX_CONTINUATIONS:
+        print("Run %s is not finished, invoke with continuation=%s" %
+              (run, run))
+        return
+    payload = dict(event, continuation=run, continuations=continuations + 1)
+    get_client('lambda').invoke(FunctionName=context.invoked_function_arn,
+                                InvocationType='Event',
+                                Payload=json.dumps(payload))
+    print("Run %s continues in a new invocation" % run)
+
+
+def index_path(region):
+    """Return the path of the 'region' index, derived from INDEX_PATH."""
+    root, ext = os.path.splitext(INDEX_PATH)
+    return '%s-%s%s' % (root, region, ext)
+
+
+def notify(sns, reports):
+    """Send one notification with the results of all regions."""
+    lines = []
+    completed = 0
+    failed = 0
+    for r in reports:
+        completed += len(r['completed'])
+        failed += len(r['failed'])
+        lines.append("%s: %d completed, %d failed, %d AMIs removed" % (
+            r['region'], len(r['completed']), len(r['failed']),
+            r['cleanup']['images']))
+        for name in r['completed']:
+            lines.append("  %s backup completed successfully." % name)
+        for name in r['failed']:
+            lines.append("  %s backup failed." % name)
+    if not completed and not failed:
+        return
+
+    sns.publish(
+        TopicArn=SNS_TOPIC,
+        Subject='Daily Backup: %d completed, %d failed' % (completed, failed),
+        Message='\n'.join(lines)
+    )
+
+
+def lambda_handler(event, context):
+    """
+    Handler for a lambda funcion.
+
+    Regions are taken from event['regions'] or REGIONS and backed up
+    concurrently. The run stops DEADLINE_MARGIN seconds before the Lambda
+    timeout, saves its checkpoint and continues in a new invocation, which
+    gets the run id as event['continuation'].
+    """
+    global COLD_START
+    METRICS.reset(COLD_START)
+    if COLD_START:
+        METRICS.phase('run', 'import', IMPORT_TIME)
+        COLD_START = False
+
+    event = event or {}
+    stop_at = None
+    if context is not None:
+        stop_at = (time.time() - DEADLINE_MARGIN +
+                   context.get_remaining_time_in_millis() / 1000.0)
+    run = event.get('continuation') or datetime.date.today().isoformat()
+    checkpoint = Checkpoint.load(run)
+
+    regions = event.get('regions') or REGIONS
+    pool = ThreadPool(len(regions))
+    try:
+        results = pool.map(
+            lambda r: call_safely(backup_region, r, checkpoint, stop_at),
+            regions)
+    finally:
+        pool.close()
+        pool.join()
+
+    if any(report is not None and not report['complete']
+           for report, _ in results):
+        checkpoint.save()
+        continue_run(event, context, run)
+        METRICS.emit()
+        return {'continuation': run}
+    if all(err is None for _, err in results):
+        checkpoint.clear()
+    else:
+        # images pending in a failed region are finished by the next run
+        checkpoint.save()
+        print("Run %s kept its checkpoint, invoke with continuation=%s to "
+              "resume the failed regions" % (run, run))
+
+    reports = []
+    failed = []
+    for region, (report, err) in zip(regions, results):
+        if err is not None:
+            print("%s: backup run failed: %s" % (region, err))
+            failed.append(region)
+            continue
+        reports.append(report)
+        failed.extend('%s/%s' % (region, name) for name in report['failed'])
+        failed.extend('%s/%s' % (region, resource_id)
+                      for resource_id, _ in report['cleanup']['failures'])
+
+    # the topic lives in the region of its ARN
+    arn = SNS_TOPIC.split(':')
+    notify(sns_connect(arn[3] if len(arn) > 3 else None), reports)
+    METRICS.emit()
+
+    if failed:
+        print("Backup failed for: " + ', '.join(failed))
+        return 1
+
 
-        # Remove old Backups
-        for img in images:
-            if today - img['created_at'] > RETENTION:
-                remove_backup(ec2, img['id'], all_snapshots[img['id']])
+# Time spent importing this module, reported by the first invocation.
+IMPORT_TIME = time.time() - IMPORT_START
+COLD_START = True
 
 # Uncomment to test
 # lambda_handler(None, None)
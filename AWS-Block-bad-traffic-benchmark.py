@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+AWS-Block-bad-traffic-benchmark.py - offline benchmark of the ban pipeline.
+
+It loads AWS-Block-bad-traffic.py with placeholder configuration and runs its
+CPU bound stages on synthetic inputs: by default 100k banned IPs, part of
+them clustered in attacking subnets and the rest scattered over the address
+space. No AWS account or Graylog is needed.
+
+For every case it reports wall time and peak memory together with the stage
+result, and writes all results as JSON to --output.
+
+Usage: AWS-Block-bad-traffic-benchmark.py [-n 100000] [-c 300] [-l 1000000]
+"""
+
+__author__ = "Lukasz Bytnar"
+__copyright__ = "Copyright 2018"
+__version__ = "0.0.1"
+__maintainer__ = "Lukasz Bytnar"
+__email__ = ""
+__status__ = "Development"
+
+import argparse
+import datetime
+import imp
+import json
+import os
+import random
+import resource
+import socket
+import struct
+import StringIO
+import time
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'AWS-Block-bad-traffic.py')
+
+PLACEHOLDER_ENV = {
+    'ENDPOINT': 'http://graylog.invalid',
+    'API_URL': '/api/search',
+    'TOKEN': 'token',
+    'S3_BUCKET_NAME': 'bucket',
+    'HIT_COUNT': '2000',
+    'LOG_FILE': 'bad_ips.log',
+    'REMOVE_AFTER': '14',
+    'NACL_ID': 'acl-00000000',
+}
+
+
+def load_script():
+    """Import the Lambda script with placeholder configuration."""
+    for key, value in PLACEHOLDER_ENV.items():
+        os.environ.setdefault(key, value)
+    return imp.load_source('block_bad_traffic', SCRIPT_PATH)
+
+
+def make_ips(count, clusters, cluster_size, seed):
+    """
+    Return 'count' distinct IPv4 addresses.
+
+    'clusters' random /24 subnets contribute 'cluster_size' addresses each,
+    the rest is scattered uniformly.
+    """
+    rnd = random.Random(seed)
+    ips = set()
+    for _ in range(clusters):
+        base = rnd.getrandbits(32) & 0xffffff00
+        for host in rnd.sample(range(256), cluster_size):
+            ips.add(base + host)
+    while len(ips) < count:
+        ips.add(rnd.getrandbits(32))
+    return [socket.inet_ntoa(struct.pack('!I', ip))
+            for ip in list(ips)[:count]]
+
+
+def measure(func, *args):
+    """Return (result, wall time) of func(*args)."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def peak_memory():
+    """Return peak RSS of the process in bytes (ru_maxrss is KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_aggregate(script, ips, budgets, max_rules):
+    """Aggregate 'ips' into 'max_rules' blocks for every budget."""
+    results = []
+    for budget in budgets:
+        script.MAX_FALSE_POSITIVES = budget
+        blocks, wall_time = measure(script.aggregate, ips, max_rules)
+        covered = sum(2 ** (32 - int(b.split('/')[1])) for b in blocks)
+        results.append({
+            'stage': 'aggregate',
+            'ips': len(ips),
+            'max_rules': max_rules,
+            'max_false_positives': budget,
+            'blocks': len(blocks),
+            'addresses_covered': covered,
+            'wall_time': round(wall_time, 3),
+            'peak_memory_bytes': peak_memory(),
+        })
+    return results
+
+
+def bench_ledger(script, ips, seed):
+    """
+    Migrate an old format ledger of 'ips', banned over the last 30 days,
+    then expire, ban again and write it in the new format.
+    """
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    old = StringIO.StringIO(''.join(
+        '%-15s %s\n' % (ip, (today - datetime.timedelta(
+            days=rnd.randint(0, 30))).strftime('%d/%m/%y 12:00'))
+        for ip in ips))
+
+    ledger, load_time = measure(script.BanLedger.load, old)
+    expired, expire_time = measure(ledger.expire, today)
+    now = int(time.time())
+    _, ban_time = measure(lambda: [ledger.ban(ip, now) for ip in expired])
+    new = StringIO.StringIO()
+    _, dump_time = measure(ledger.dump, new)
+    return [{
+        'stage': 'ledger',
+        'ips': len(ips),
+        'expired': len(expired),
+        'old_format_bytes': len(old.getvalue()),
+        'new_format_bytes': len(new.getvalue()),
+        'load_time': round(load_time, 3),
+        'expire_time': round(expire_time, 3),
+        'ban_time': round(ban_time, 3),
+        'dump_time': round(dump_time, 3),
+        'wall_time': round(load_time + expire_time + ban_time + dump_time,
+                           3),
+        'peak_memory_bytes': peak_memory(),
+    }]
+
+
+def bench_stream(script, ips, seed):
+    """
+    Read a Graylog response with a term for every one of 'ips' as a stream,
+    then with json.load for comparison.
+
+    Peak memory only grows, so the stream is read first.
+    """
+    rnd = random.Random(seed)
+    response = json.dumps({'result': {
+        'terms': dict((ip, rnd.randint(1, 2 * script.HIT_COUNT))
+                      for ip in ips),
+        'missing': 0, 'time': 100}})
+
+    memory_before = peak_memory()
+    bad_ips, stream_time = measure(
+        lambda: sum(1 for _ in script.get_bad_ips(
+            StringIO.StringIO(response))))
+    stream_memory = peak_memory()
+    _, load_time = measure(lambda: json.load(StringIO.StringIO(response)))
+    return [{
+        'stage': 'stream',
+        'terms': len(ips),
+        'bad_ips': bad_ips,
+        'response_bytes': len(response),
+        'wall_time': round(stream_time, 3),
+        'peak_memory_bytes': stream_memory,
+        'peak_memory_growth_bytes': stream_memory - memory_before,
+        'json_load_time': round(load_time, 3),
+        'json_load_peak_memory_growth_bytes': peak_memory() - stream_memory,
+    }]
+
+
+def bench_detect(script, ips, lines, attackers, seed):
+    """
+    Detect 'attackers' among 'lines' access log lines from 'ips', spread
+    over DETECT_LOOKBACK seconds.
+
+    Every attacker makes twice HIT_COUNT hits within one DETECT_WINDOW.
+    """
+    rnd = random.Random(seed)
+    now = int(time.time())
+    lookback = script.DETECT_LOOKBACK
+    events = [(now - rnd.randint(0, lookback), rnd.choice(ips))
+              for _ in range(lines)]
+    bad = ['192.0.2.%d' % i for i in range(attackers)]
+    for ip in bad:
+        start = now - rnd.randint(script.DETECT_WINDOW, lookback)
+        events.extend((start + rnd.randint(0, script.DETECT_WINDOW - 1), ip)
+                      for _ in range(2 * script.HIT_COUNT))
+    events.sort()
+    log = ['%s - - [%s +0000] "GET / HTTP/1.1" 200 512' % (
+        ip, time.strftime('%d/%b/%Y:%H:%M:%S', time.gmtime(t)))
+        for t, ip in events]
+    del events
+
+    memory_before = peak_memory()
+    found, wall_time = measure(
+        lambda: dict(script.detect_heavy_hitters(log, now - lookback)))
+    return [{
+        'stage': 'detect',
+        'lines': len(log),
+        'attackers': attackers,
+        'detected': len(found),
+        'missed': len(set(bad) - set(found)),
+        'capacity': script.HEAVY_HITTER_CAPACITY,
+        'wall_time': round(wall_time, 3),
+        'lines_per_second': int(len(log) / wall_time),
+        'peak_memory_bytes': peak_memory(),
+        'peak_memory_growth_bytes': peak_memory() - memory_before,
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark AWS-Block-bad-traffic.py on synthetic bans.')
+    parser.add_argument('-n', '--ips', type=int, default=100000,
+                        help='number of banned IPs')
+    parser.add_argument('-c', '--clusters', type=int, default=300,
+                        help='attacking /24 subnets')
+    parser.add_argument('--cluster-size', type=int, default=200,
+                        help='banned IPs per attacking subnet')
+    parser.add_argument('-b', '--budgets', default='0,4096,65536',
+                        help='comma separated false positive budgets')
+    parser.add_argument('-r', '--rules', type=int, default=99,
+                        help='NACL rules available for bans')
+    parser.add_argument('-l', '--lines', type=int, default=1000000,
+                        help='access log lines scanned by the detector')
+    parser.add_argument('-a', '--attackers', type=int, default=20,
+                        help='heavy hitters hidden in the access log')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', default='block-benchmark.json',
+                        help='file to write the JSON results to')
+    args = parser.parse_args()
+
+    script = load_script()
+    ips = make_ips(args.ips, args.clusters, args.cluster_size, args.seed)
+
+    results = bench_stream(script, ips, args.seed)
+    results += bench_aggregate(script, ips,
+                              [int(b) for b in args.budgets.split(',')],
+                              args.rules)
+    results += bench_ledger(script, ips, args.seed)
+    results += bench_detect(script, ips, args.lines, args.attackers,
+                            args.seed)
+    for r in results:
+        print "%-10s %8.3fs, peak %6.1f MiB  %s" % (
+            r['stage'], r['wall_time'], r['peak_memory_bytes'] / 2.0 ** 20,
+            ', '.join('%s=%s' % (k, v) for k, v in sorted(r.items())
+                      if k not in ('stage', 'wall_time',
+                                   'peak_memory_bytes')))
+
+    with open(args.output, 'w') as output:
+        json.dump({'generated_at': datetime.datetime.utcnow().isoformat(),
+                   'results': results}, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
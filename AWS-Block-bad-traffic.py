@@ -4,6 +4,22 @@ AWS-Block-bad-traffic.py for AWS Lambda.
 
 This script gets IPs from graylog that had over 2000 hits and ban them for
 2 weeks. After that it removes them from ban list.
+
+Banned IPs are aggregated into CIDR blocks, so that they fit into the ban
+backend selected by BAN_BACKEND: the rules of the NACL numbered within
+NACL_RULE_RANGE (nacl), a WAFv2 IP set (waf) or an EC2 managed prefix list
+(prefix-list). The latter two hold thousands of blocks, and must be
+referenced by a blocking WAF rule or firewall rule respectively.
+
+IPs are found by the Graylog terms query (DETECTOR=graylog), or by scanning
+access logs in S3 or local files (DETECTOR=logs) for IPs with over HIT_COUNT
+hits within DETECT_WINDOW seconds, in memory that does not grow with the
+volume of logs.
+
+The ledger of bans is kept in S3. Warm invocations reuse their copy while the
+object is not modified, and save it only when it changed and nobody else
+saved it in the meantime. With LEDGER_LOCK_TABLE, a DynamoDB table with the
+string hash key 'ledger', overlapping invocations save it one at a time.
 """
 
 __author__ = "Lukasz Bytnar"
@@ -13,154 +29,1403 @@ __maintainer__ = "Lukasz Bytnar"
 __email__ = ""
 __status__ = "Production"
 
-import boto3
-from urllib2 import Request, urlopen, URLError
+import time
+IMPORT_START = time.time()
+
+from urllib2 import URLError
+from urlparse import urlparse
 from base64 import b64encode
+from botocore.exceptions import ClientError
+from cStringIO import StringIO
 import json
 from datetime import datetime, date, timedelta
+import bisect
+import calendar
+import glob
+import gzip
+import hashlib
+import heapq
+import httplib
+import itertools
 import os
+import Queue
+import random
+import re
+import socket
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
 
-ENDPOINT = os.environ['ENDPOINT']
-API_URL = os.environ['API_URL']
-TOKEN = os.environ['TOKEN']
+DETECTOR = os.environ.get('DETECTOR', 'graylog')
+ENDPOINT = os.environ.get('ENDPOINT')
+API_URL = os.environ.get('API_URL', '')
+# Several terms queries, for other streams or time ranges, may be given as
+# whitespace separated paths. Their counts are added up.
+API_URLS = os.environ.get('API_URLS', API_URL).split()
+TOKEN = os.environ.get('TOKEN', '')
 TOKEN_B64 = b64encode(TOKEN)
 S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
 HIT_COUNT = int(os.environ['HIT_COUNT'])
-LOG_FILE_DIR = '/tmp/'
 LOG_FILE = os.environ['LOG_FILE']
-LOG_FILE_DATA = []
 REMOVE_AFTER = int(os.environ['REMOVE_AFTER'])
 REMOVE_AFTER_DELTA = timedelta(days=REMOVE_AFTER)
-NACL_ID = os.environ['NACL_ID']
+# Access logs scanned by the logs detector: s3://bucket/prefix or a local
+# glob, in the 'combined' (Apache, nginx) or 'alb' format.
+LOG_SOURCE = os.environ.get('LOG_SOURCE')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'combined')
+# Hits are counted in DETECT_WINDOW long windows, sliding by DETECT_STEP over
+# the last DETECT_LOOKBACK seconds of logs, all in seconds.
+DETECT_WINDOW = int(os.environ.get('DETECT_WINDOW', 300))
+DETECT_STEP = int(os.environ.get('DETECT_STEP', 60))
+DETECT_LOOKBACK = int(os.environ.get('DETECT_LOOKBACK', 900))
+# IPs counted in each DETECT_STEP, the memory bound of the logs detector.
+HEAVY_HITTER_CAPACITY = int(os.environ.get('HEAVY_HITTER_CAPACITY', 2048))
+BAN_BACKEND = os.environ.get('BAN_BACKEND', 'nacl')
+NACL_ID = os.environ.get('NACL_ID')
 NACL_FILTER = [
     {'Name': 'association.network-acl-id',
      'Values': [NACL_ID]}
 ]
+# NACL rule numbers reserved for bans, 'first-last', e.g. '50-99'. Every deny
+# rule within is owned by this script, rules outside are never changed.
+NACL_RULE_RANGE = os.environ.get('NACL_RULE_RANGE')
+WAF_IP_SET_NAME = os.environ.get('WAF_IP_SET_NAME')
+WAF_IP_SET_ID = os.environ.get('WAF_IP_SET_ID')
+# CLOUDFRONT IP sets can only be managed from us-east-1.
+WAF_SCOPE = os.environ.get('WAF_SCOPE', 'REGIONAL')
+# Addresses in an IP set, the default WAF quota.
+WAF_IP_SET_CAPACITY = int(os.environ.get('WAF_IP_SET_CAPACITY', 10000))
+# Attempts to update the IP set when others keep modifying it.
+WAF_MAX_ATTEMPTS = 5
+PREFIX_LIST_ID = os.environ.get('PREFIX_LIST_ID')
+# Entries added or removed by a single prefix list modification, and how long
+# to wait for one to complete.
+PREFIX_LIST_CHUNK_SIZE = 100
+PREFIX_LIST_POLL_DELAY = 2
+PREFIX_LIST_TIMEOUT = 120
+BAN_DESCRIPTION = 'Banned by AWS-Block-bad-traffic'
+# Aggregation of banned IPs into CIDR blocks: unbanned addresses that may be
+# covered in total, and the shortest block that may be created.
+MAX_FALSE_POSITIVES = int(os.environ.get('MAX_FALSE_POSITIVES', 4096))
+MIN_PREFIX_LEN = int(os.environ.get('MIN_PREFIX_LEN', 20))
+# Times the addresses of blocks kept within the rule limit are merged again.
+AGGREGATE_MAX_PASSES = 3
+# Attempts to save the ledger when other invocations keep modifying it. The
+# optional DynamoDB table of the lock held while saving it, seconds after
+# which a lock of a crashed invocation expires, seconds to wait for the lock
+# and between its checks.
+LEDGER_MAX_ATTEMPTS = 5
+LEDGER_LOCK_TABLE = os.environ.get('LEDGER_LOCK_TABLE')
+LEDGER_LOCK_TTL = 60
+LEDGER_LOCK_TIMEOUT = 30
+LEDGER_LOCK_POLL_DELAY = 0.5
+# Graylog connect and read timeouts in seconds, retries of a failed query
+# with the delay doubling from GRAYLOG_RETRY_BASE_DELAY, and queries made
+# concurrently.
+GRAYLOG_CONNECT_TIMEOUT = float(os.environ.get('GRAYLOG_CONNECT_TIMEOUT', 5))
+GRAYLOG_READ_TIMEOUT = float(os.environ.get('GRAYLOG_READ_TIMEOUT', 30))
+GRAYLOG_MAX_RETRIES = 3
+GRAYLOG_RETRY_BASE_DELAY = 1
+GRAYLOG_MAX_WORKERS = 4
+# Path of keys to the map of IP -> hit count in the Graylog response, and the
+# size of the chunks it is read in.
+TERMS_PATH = ('result', 'terms')
+STREAM_CHUNK_SIZE = 64 * 1024
+# Regex with the 'ip', 'time' and optionally 'zone' of a log line, and the
+# strptime format of its time.
+LOG_FORMATS = {
+    'combined': (re.compile(r'(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\] ]+) '
+                            r'(?P<zone>[+-]\d{4})\]'),
+                 '%d/%b/%Y:%H:%M:%S'),
+    'alb': (re.compile(r'\S+ (?P<time>[^.\s]+)\S* \S+ (?P<ip>[^:\s]+):'),
+            '%Y-%m-%dT%H:%M:%S'),
+}
+# NACL rules changed concurrently, within the default connection pool of 10.
+NACL_MAX_WORKERS = 8
+# Attempts of a call, including retries, made by the clients themselves.
+CLIENT_MAX_ATTEMPTS = 10
+
+
+# Clients are created on first use and reused by warm invocations.
+CLIENTS = dict()
+
+
+def get_client(service):
+    """Return the cached boto3 client for 'service'."""
+    if service not in CLIENTS:
+        # boto3 is imported on first use, it dominates import time
+        import boto3
+        from botocore.config import Config
+        CLIENTS[service] = boto3.client(service, config=Config(
+            retries={'mode': 'adaptive', 'max_attempts': CLIENT_MAX_ATTEMPTS}))
+    return CLIENTS[service]
 
 
 def ec2_connect():
     """Return connection object for ec2."""
-    return boto3.client('ec2')
+    return get_client('ec2')
 
 
 def s3_connect():
     """Return connection object for s3."""
-    return boto3.client('s3')
-
-
-def get_free_rules_number(acl, deleted):
-    """Find the next acl rule number."""
-    rules_list = acl['NetworkAcls'][0]['Entries']
-    rules_used = [rule['RuleNumber']
-                  for rule in rules_list if not rule['Egress']]
-    rules_free = [num for num in range(1, 100) if num not in rules_used]
-    rules_free = rules_free + deleted
-    rules_free.sort()
-    return rules_free
-
-
-def get_blocked_ips(acl, ips_removed):
-    """Get the list of IPs that are denied already."""
-    blocked_ips = []
-    for rule in acl['NetworkAcls'][0]['Entries']:
-        if rule['RuleAction'] == 'deny' and not rule['Egress']:
-            blocked_ips.append(rule['CidrBlock'].split('/')[0])
-    return list(set(blocked_ips) - set(ips_removed))
-
-
-def read_log_data():
-    """Read data from log file."""
-    global LOG_FILE_DIR
-    global LOG_FILE_DATA
-    global LOG_FILE
-
-    with open(LOG_FILE_DIR + LOG_FILE, 'r') as logfile:
-        LOG_FILE_DATA = logfile.readlines()
-
-
-def get_ips_to_remove():
-    """Retrieve IPs that should be unblocked."""
-    global LOG_FILE_DATA
-    read_log_data()
-    ips_to_remove = []
-
-    # iterate over copy of original LOG_FILE_DATA
-    for line in list(LOG_FILE_DATA):
-        rule_date = datetime.strptime(line.split()[1], '%d/%m/%y').date()
-        if date.today() - rule_date > REMOVE_AFTER_DELTA:
-            ips_to_remove.append(line.split()[0])
-            LOG_FILE_DATA.remove(line)
-    return ips_to_remove
-
-
-def delete_rules(ec2, ips, acl):
-    """Remove NACL rule."""
-    global LOG_FILE_DATA
-    rule_deleted = []
-    for rule in acl['NetworkAcls'][0]['Entries']:
-        if rule['Egress'] or rule['RuleAction'] == 'allow':
+    return get_client('s3')
+
+
+def wafv2_connect():
+    """Return connection object for wafv2."""
+    return get_client('wafv2')
+
+
+def dynamodb_connect():
+    """Return connection object for dynamodb."""
+    return get_client('dynamodb')
+
+
+class JSONStream(object):
+    """
+    Incremental reader of a JSON document from a file-like object.
+
+    The document is read in STREAM_CHUNK_SIZE chunks and only the part not
+    consumed yet is buffered, so objects can be walked member by member
+    without loading the whole document.
+    """
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    # a complete '"key": integer' member, up to and including its separator
+    COUNT = re.compile(r'[ \t\n\r]*"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*(-?\d+)'
+                       r'[ \t\n\r]*([,}])')
+    # characters a number may start with, and continue with
+    NUMBER_START = '-0123456789'
+    NUMBER_CHARS = '.eE+-0123456789'
+    decoder = json.JSONDecoder()
+
+    def __init__(self, stream, chunk_size=STREAM_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """Read the next chunk, return False at the end of the stream."""
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character, '' at the end."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        """Consume 'char', which must be the next non-whitespace one."""
+        if self.peek() != char:
+            raise ValueError('Expected %r, got %r' % (char, self.peek()))
+        self.pos += 1
+
+    def value(self):
+        """Decode and return the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # incomplete value, unless the stream has ended
+                if not self.fill():
+                    raise
+                continue
+            # a number may continue in the next chunk, after its integer
+            # part as well
+            if (self.buf[self.pos] not in self.NUMBER_START or
+                    end < len(self.buf) and
+                    self.buf[end] not in self.NUMBER_CHARS or
+                    not self.fill()):
+                self.pos = end
+                return value
+
+    def elements(self, open_char, close_char):
+        """Yield once per element of the next object or array."""
+        self.expect(open_char)
+        if self.peek() == close_char:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == close_char:
+                return
+            if char != ',':
+                raise ValueError('Expected %r or %r, got %r' % (
+                    ',', close_char, char))
+
+    def members(self):
+        """
+        Yield keys of the next object.
+
+        The value of each key must be read, with value() or skip(), before
+        the next key.
+        """
+        for _ in self.elements('{', '}'):
+            key = self.value()
+            self.expect(':')
+            yield key
+
+    def counts(self):
+        """
+        Yield (key, value) of the next object, of integer values mostly.
+
+        Members matching COUNT in the buffer are parsed in one step, others
+        are decoded like in members().
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            match = self.COUNT.match(self.buf, self.pos)
+            if match is not None:
+                self.pos = match.end()
+                yield match.group(1), int(match.group(2))
+                if match.group(3) == '}':
+                    return
+                continue
+            key = self.value()
+            self.expect(':')
+            yield key, self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError('Expected %r or %r, got %r' % (
+                    ',', '}', char))
+
+    def skip(self):
+        """Skip the next value, walking containers element by element."""
+        char = self.peek()
+        if char == '{':
+            for _ in self.members():
+                self.skip()
+        elif char == '[':
+            for _ in self.elements('[', ']'):
+                self.skip()
+        else:
+            self.value()
+
+    def find(self, path):
+        """Move to the value at 'path' of keys, return False if missing."""
+        for key in path:
+            if self.peek() != '{':
+                return False
+            for member in self.members():
+                if member == key:
+                    break
+                self.skip()
+            else:
+                return False
+        return True
+
+
+def get_bad_ips(response, min_count=HIT_COUNT):
+    """
+    Yield (ip, count) of IPs with over 'min_count' hits, as the Graylog
+    'response' is read.
+    """
+    stream = JSONStream(response)
+    if not stream.find(TERMS_PATH):
+        print 'No %s in the response.' % '.'.join(TERMS_PATH)
+        return
+    for ip, count in stream.counts():
+        if count > min_count:
+            yield ip, count
+
+
+# Idle keep-alive connections to Graylog, reused by warm invocations.
+GRAYLOG_CONNECTIONS = Queue.Queue()
+
+
+def graylog_connection():
+    """Return an idle connection to ENDPOINT, or a new one."""
+    try:
+        return GRAYLOG_CONNECTIONS.get_nowait()
+    except Queue.Empty:
+        url = urlparse(ENDPOINT)
+        if url.scheme == 'https':
+            return httplib.HTTPSConnection(url.netloc,
+                                           timeout=GRAYLOG_CONNECT_TIMEOUT)
+        return httplib.HTTPConnection(url.netloc,
+                                      timeout=GRAYLOG_CONNECT_TIMEOUT)
+
+
+def graylog_query(path, min_count=HIT_COUNT):
+    """
+    Return map of IP -> hits of IPs with over 'min_count' hits in the terms
+    query at 'path' of ENDPOINT.
+
+    Connection errors, timeouts and 429 or 5xx responses are retried up to
+    GRAYLOG_MAX_RETRIES times, the delay doubling from
+    GRAYLOG_RETRY_BASE_DELAY with full jitter. The connection is kept open
+    for the next query.
+    """
+    url = urlparse(ENDPOINT + path)
+    target = url.path + ('?' + url.query if url.query else '')
+    headers = {'Authorization': 'Basic %s' % TOKEN_B64,
+               'Accept': 'application/json'}
+    for attempt in range(GRAYLOG_MAX_RETRIES + 1):
+        if attempt:
+            time.sleep(random.uniform(
+                0, GRAYLOG_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+        conn = graylog_connection()
+        try:
+            if conn.sock is None:
+                conn.connect()
+            conn.sock.settimeout(GRAYLOG_READ_TIMEOUT)
+            conn.request('GET', target, headers=headers)
+            response = conn.getresponse()
+            if response.status == 429 or response.status >= 500:
+                response.read()
+                error = 'HTTP %d %s' % (response.status, response.reason)
+            elif response.status != 200:
+                conn.close()
+                raise URLError('HTTP %d %s' % (response.status,
+                                               response.reason))
+            else:
+                try:
+                    counts = dict(get_bad_ips(response, min_count))
+                except ValueError:
+                    conn.close()
+                    raise
+                # the rest of the body, so that the connection can be reused
+                response.read()
+                GRAYLOG_CONNECTIONS.put(conn)
+                return counts
+        except (socket.error, httplib.HTTPException), e:
+            conn.close()
+            error = '%s: %s' % (e.__class__.__name__, e)
+        print 'Graylog query %s failed (%s), attempt %d.' % (
+            path, error, attempt + 1)
+        # a closed connection is opened again when it is reused
+        GRAYLOG_CONNECTIONS.put(conn)
+    raise URLError(error)
+
+
+class SpaceSaving(object):
+    """
+    Approximate hit counts of the most frequent IPs, in bounded memory.
+
+    At most 'capacity' IPs are counted. A new IP replaces one with the lowest
+    count and inherits that count as its error, so every count is an upper
+    bound and count - error a lower bound of its true hits. Any IP with over
+    1/capacity of all hits is counted. IPs are kept in buckets by count, so
+    every hit is O(1).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = dict()
+        self.errors = dict()
+        self.buckets = dict()
+        self.min_count = 0
+
+    def add(self, ip):
+        """Count a hit of 'ip'."""
+        count = self.counts.get(ip)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+                self.min_count = 0
+            else:
+                count = self.min_count
+                victim = self.buckets[count].pop()
+                del self.counts[victim]
+                del self.errors[victim]
+                if not self.buckets[count]:
+                    del self.buckets[count]
+            self.errors[ip] = count
+        else:
+            bucket = self.buckets[count]
+            bucket.remove(ip)
+            if not bucket:
+                del self.buckets[count]
+        self.counts[ip] = count + 1
+        self.buckets.setdefault(count + 1, set()).add(ip)
+        if count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+
+    def lower_bounds(self):
+        """Return map of IP -> guaranteed hits of the counted IPs."""
+        errors = self.errors
+        return dict((ip, count - errors[ip])
+                    for ip, count in self.counts.iteritems())
+
+
+def iter_lines(stream, gzipped=False):
+    """Yield lines of 'stream', read in STREAM_CHUNK_SIZE chunks."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    rest = ''
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if decompressor is not None:
+            chunk = (decompressor.decompress(chunk) if chunk
+                     else decompressor.flush())
+        if not chunk:
+            break
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def iter_log_lines(since):
+    """Yield lines of LOG_SOURCE logs modified after 'since' epoch time."""
+    if LOG_SOURCE.startswith('s3://'):
+        s3 = s3_connect()
+        bucket, _, prefix = LOG_SOURCE[len('s3://'):].partition('/')
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if calendar.timegm(obj['LastModified'].utctimetuple()) < since:
+                    continue
+                body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body']
+                for line in iter_lines(body, obj['Key'].endswith('.gz')):
+                    yield line
+    else:
+        for path in sorted(glob.glob(LOG_SOURCE)):
+            if os.path.getmtime(path) < since:
+                continue
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rb') as log_file:
+                for line in log_file:
+                    yield line
+
+
+def detect_heavy_hitters(lines, since):
+    """
+    Return (ip, count) pairs of IPs with over HIT_COUNT hits in any
+    DETECT_WINDOW of log 'lines' logged after 'since' epoch time.
+
+    Hits are counted by a SpaceSaving summary for every DETECT_STEP, and a
+    window sums the guaranteed counts of its steps, so no IP is banned for
+    more hits than it made.
+    """
+    pattern, time_format = LOG_FORMATS[LOG_FORMAT]
+    time_groups = ('time', 'zone') if 'zone' in pattern.groupindex else \
+        ('time', 'time')
+    steps = dict()
+    last_time, summary = None, None
+    lines_read = lines_matched = 0
+    for line in lines:
+        lines_read += 1
+        match = pattern.match(line)
+        if match is None:
+            continue
+        # lines come in order, their time seldom changes from one to the next
+        if match.group(*time_groups) != last_time:
+            last_time = match.group(*time_groups)
+            summary = None
+            try:
+                epoch = calendar.timegm(time.strptime(last_time[0],
+                                                      time_format))
+            except ValueError:
+                continue
+            if time_groups[1] == 'zone':
+                zone = last_time[1]
+                epoch -= int(zone[0] + '1') * (int(zone[1:3]) * 3600 +
+                                               int(zone[3:]) * 60)
+            if epoch >= since:
+                step = epoch // DETECT_STEP
+                if step not in steps:
+                    steps[step] = SpaceSaving(HEAVY_HITTER_CAPACITY)
+                summary = steps[step]
+        if summary is None:
+            continue
+        lines_matched += 1
+        summary.add(match.group('ip'))
+    print 'Logs: %d lines read, %d counted in %d steps.' % (
+        lines_read, lines_matched, len(steps))
+
+    bounds = dict((step, summary.lower_bounds())
+                  for step, summary in steps.iteritems())
+    window_steps = max(1, DETECT_WINDOW // DETECT_STEP)
+    hits = dict()
+    for last in steps:
+        window = [bounds[step]
+                  for step in range(last - window_steps + 1, last + 1)
+                  if step in bounds]
+        for ip in set(itertools.chain.from_iterable(window)):
+            count = sum(counts.get(ip, 0) for counts in window)
+            if count > hits.get(ip, HIT_COUNT):
+                hits[ip] = count
+    return hits.iteritems()
+
+
+def find_bad_ips():
+    """Yield (ip, count) of IPs to ban, found by DETECTOR."""
+    if DETECTOR == 'logs':
+        since = time.time() - DETECT_LOOKBACK
+        return detect_heavy_hitters(iter_log_lines(since), since)
+    if DETECTOR == 'graylog' and len(API_URLS) == 1:
+        return graylog_query(API_URLS[0]).iteritems()
+    if DETECTOR == 'graylog':
+        # an IP may only be over HIT_COUNT in total, all counts are needed
+        pool = ThreadPool(min(GRAYLOG_MAX_WORKERS, len(API_URLS)))
+        try:
+            results = pool.map(lambda path: graylog_query(path, 0), API_URLS)
+        finally:
+            pool.close()
+            pool.join()
+        hits = dict()
+        for counts in results:
+            for ip, count in counts.iteritems():
+                hits[ip] = hits.get(ip, 0) + count
+        return ((ip, count) for ip, count in hits.iteritems()
+                if count > HIT_COUNT)
+    raise RuntimeError('Unknown DETECTOR: %s' % DETECTOR)
+
+
+def get_rule_numbers():
+    """Return the set of NACL rule numbers in NACL_RULE_RANGE."""
+    try:
+        first, last = [int(n) for n in NACL_RULE_RANGE.split('-')]
+    except (AttributeError, ValueError):
+        raise ValueError('NACL_RULE_RANGE must be set to the rule numbers '
+                         'reserved for bans, e.g. 50-99, not %r'
+                         % NACL_RULE_RANGE)
+    if not 1 <= first <= last <= 32766:
+        raise ValueError('Invalid NACL_RULE_RANGE: %s' % NACL_RULE_RANGE)
+    return set(range(first, last + 1))
+
+
+def get_free_rules_number(acl, rule_numbers):
+    """Return the sorted list of unused ingress 'rule_numbers'."""
+    rules_used = set(rule['RuleNumber']
+                     for rule in acl['NetworkAcls'][0]['Entries']
+                     if not rule['Egress'])
+    return sorted(rule_numbers - rules_used)
+
+
+def get_owned_rules(acl, ledger, rule_numbers):
+    """
+    Return rule numbers of the ban rules made by this script.
+
+    These are ingress deny rules within 'rule_numbers', so that a rule is
+    owned even if the ledger recording it was never saved. Rules outside of
+    them are owned if 'ledger' records them, or if they block a single IP of
+    it, as older versions did, so that they are removed once expired. Other
+    deny rules are left alone.
+    """
+    recorded = ledger.rules()
+    return set(rule['RuleNumber']
+               for rule in acl['NetworkAcls'][0]['Entries']
+               if not rule['Egress'] and rule['RuleAction'] == 'deny' and
+               'CidrBlock' in rule and
+               (rule['RuleNumber'] in rule_numbers or
+                rule['RuleNumber'] in recorded or
+                rule['CidrBlock'].endswith('/32') and
+                rule['CidrBlock'][:-3] in ledger))
+
+
+def get_ban_rules(acl, owned):
+    """Return map of CIDR block -> rule number of the 'owned' ban rules."""
+    return dict((rule['CidrBlock'], rule['RuleNumber'])
+                for rule in acl['NetworkAcls'][0]['Entries']
+                if not rule['Egress'] and rule['RuleAction'] == 'deny' and
+                rule['RuleNumber'] in owned and 'CidrBlock' in rule)
+
+
+def get_rules_limit(acl, owned, rule_numbers):
+    """Return how many ban rules fit in 'rule_numbers'."""
+    other_rules = [rule for rule in acl['NetworkAcls'][0]['Entries']
+                   if not rule['Egress'] and
+                   rule['RuleNumber'] in rule_numbers and
+                   (rule['RuleAction'] != 'deny' or
+                    rule['RuleNumber'] not in owned)]
+    return len(rule_numbers) - len(other_rules)
+
+
+def ip_to_int(ip):
+    """Return IPv4 address as an integer, or None if it is not IPv4."""
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, UnicodeError):
+        return None
+
+
+def int_to_cidr(start, end):
+    """Return CIDR block of the aligned start-end address range."""
+    prefix_len = 32 - (end - start + 1).bit_length() + 1
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', start)),
+                      prefix_len)
+
+
+def merge_blocks(addrs, max_rules):
+    """
+    Merge sorted addresses 'addrs' into CIDR blocks, see aggregate().
+
+    Return the list of (start, end, banned addresses) of the blocks, ordered
+    by address.
+    """
+    size = len(addrs)
+    start = list(addrs)
+    end = list(addrs)
+    banned = [1] * size
+    prev = range(-1, size - 1)
+    next_ = range(1, size + 1)
+    if size:
+        next_[-1] = -1
+    alive = [True] * size
+    version = [0] * size
+
+    def measure(i):
+        """Return the merge of block i with the next one, or None."""
+        j = next_[i]
+        diff_bits = (start[i] ^ end[j]).bit_length()
+        if 32 - diff_bits < MIN_PREFIX_LEN:
+            return None
+        low = start[i] >> diff_bits << diff_bits
+        high = low + (1 << diff_bits) - 1
+        # the supernet may swallow more neighbours on either side
+        first = i
+        while prev[first] != -1 and start[prev[first]] >= low:
+            first = prev[first]
+        last = j
+        while next_[last] != -1 and end[next_[last]] <= high:
+            last = next_[last]
+        covered = 0
+        merged = 0
+        k = first
+        while True:
+            covered += end[k] - start[k] + 1
+            merged += 1
+            if k == last:
+                break
+            k = next_[k]
+        cost = high - low + 1 - covered
+        return float(cost) / (merged - 1), cost, first, last, low, high
+
+    heap = []
+
+    def push(i):
+        if i != -1 and next_[i] != -1:
+            merge = measure(i)
+            if merge is not None:
+                heapq.heappush(heap, (merge[0], merge[1], i, version[i],
+                                      next_[i], version[next_[i]]))
+
+    for i in range(size - 1):
+        push(i)
+
+    blocks = size
+    false_positives = 0
+    while heap:
+        ratio, cost, i, version_i, j, version_j = heapq.heappop(heap)
+        if (not alive[i] or not alive[j] or next_[i] != j or
+                version[i] != version_i or version[j] != version_j):
+            continue
+        if cost > 0 and blocks <= max_rules:
+            break
+        merge = measure(i)
+        if merge[:2] != (ratio, cost):
+            # blocks around it were merged since, requeue at its new cost
+            heapq.heappush(heap, (merge[0], merge[1], i, version[i], j,
+                                  version[j]))
+            continue
+        if false_positives + cost > MAX_FALSE_POSITIVES:
+            continue
+
+        _, _, first, last, low, high = merge
+        k = next_[first]
+        while True:
+            alive[k] = False
+            banned[first] += banned[k]
+            blocks -= 1
+            if k == last:
+                break
+            k = next_[k]
+        start[first] = low
+        end[first] = high
+        version[first] += 1
+        next_[first] = next_[last]
+        if next_[last] != -1:
+            prev[next_[last]] = first
+        false_positives += cost
+        push(prev[first])
+        push(first)
+
+    return [(start[k], end[k], banned[k]) for k in range(size) if alive[k]]
+
+
+def expand_blocks(blocks, addrs, budget):
+    """
+    Grow 'blocks' of aggregate() into their supernets within 'budget'.
+
+    A block is grown one prefix bit at a time when that covers more of the
+    sorted banned addresses 'addrs', that did not fit in the rule limit,
+    without overlapping another block. The growth that covers the fewest
+    unbanned addresses per banned one wins.
+
+    Return the list of (start, end, banned addresses) of the blocks.
+    """
+    blocks = [list(block) for block in blocks]
+
+    def measure(k):
+        """Return the growth of block k, or None."""
+        start, end, banned = blocks[k]
+        size = end - start + 1
+        if 32 - size.bit_length() < MIN_PREFIX_LEN:
+            return None
+        low = start & ~(2 * size - 1)
+        high = low + 2 * size - 1
+        if (k > 0 and blocks[k - 1][1] >= low or
+                k + 1 < len(blocks) and blocks[k + 1][0] <= high):
+            return None
+        covered = (bisect.bisect_right(addrs, high) -
+                   bisect.bisect_left(addrs, low))
+        if covered == banned:
+            return None
+        cost = size - (covered - banned)
+        return float(cost) / (covered - banned), cost, low, high, covered
+
+    heap = []
+
+    def push(k):
+        growth = measure(k)
+        if growth is not None:
+            heapq.heappush(heap, growth[:2] + (k, blocks[k][0]))
+
+    for k in range(len(blocks)):
+        push(k)
+    while heap:
+        ratio, cost, k, start = heapq.heappop(heap)
+        growth = measure(k)
+        if growth is None or blocks[k][0] != start:
+            continue
+        if growth[:2] != (ratio, cost):
+            # a neighbour grew since, requeue at the new cost
+            push(k)
+            continue
+        if cost > budget:
             continue
+        budget -= cost
+        blocks[k] = list(growth[2:])
+        push(k)
+    return [tuple(block) for block in blocks]
+
+
+def aggregate(ips, max_rules):
+    """
+    Cover banned 'ips' with at most 'max_rules' CIDR blocks.
+
+    Starting from one /32 per address, neighbouring blocks are merged into
+    their smallest common supernet, cheapest first: the merge that covers
+    the fewest unbanned addresses per saved rule wins. Merges that cover no
+    unbanned address are always made. Others are made only while blocks do
+    not fit in 'max_rules', while the unbanned addresses stay within
+    MAX_FALSE_POSITIVES and no block is shorter than MIN_PREFIX_LEN. If the
+    blocks still do not fit, the ones with the fewest banned addresses are
+    left out, and the addresses of the rest are merged again, up to
+    AGGREGATE_MAX_PASSES times, so that the budget is only spent on blocks
+    that are kept. What is left of it grows them to cover more of the left
+    out addresses.
+
+    Return the list of CIDR blocks, ordered by address.
+    """
+    addrs = sorted(set(n for n in (ip_to_int(ip) for ip in ips)
+                       if n is not None))
+    all_addrs = addrs
+    size = len(addrs)
+    for _ in range(AGGREGATE_MAX_PASSES):
+        blocks = merge_blocks(addrs, max_rules)
+        if len(blocks) <= max_rules:
+            break
+        kept = sorted(sorted(blocks, key=lambda block: block[2],
+                             reverse=True)[:max_rules])
+        starts = [block[0] for block in kept]
+        kept_addrs = []
+        for n in addrs:
+            k = bisect.bisect(starts, n) - 1
+            if k >= 0 and n <= kept[k][1]:
+                kept_addrs.append(n)
+        addrs = kept_addrs
+    else:
+        blocks = sorted(sorted(blocks, key=lambda block: block[2],
+                               reverse=True)[:max_rules])
+    false_positives = sum(end - start + 1 - banned
+                          for start, end, banned in blocks)
+    if sum(banned for _, _, banned in blocks) < size:
+        blocks = expand_blocks(blocks, all_addrs,
+                               MAX_FALSE_POSITIVES - false_positives)
+    left_out = size - sum(banned for _, _, banned in blocks)
+    if left_out:
+        print 'Ban limit reached, %d banned IPs are not blocked!' % left_out
+    false_positives = sum(end - start + 1 - banned
+                          for start, end, banned in blocks)
+    print '%d banned IPs in %d blocks, %d unbanned IPs covered' % (
+        size, len(blocks), false_positives)
+    return [int_to_cidr(start, end) for start, end, _ in blocks]
+
+
+class BanLedger(object):
+    """
+    Banned IPs with the time of the ban and the NACL rule blocking them.
+
+    Bans are kept in a dict by IP and in a min-heap by the day they expire,
+    so membership is O(1) and expiring k bans is O(k log n). Heap entries of
+    IPs banned again are skipped when they come up.
+
+    The ledger file holds one 'ip epoch rule' line per ban after a HEADER
+    line. Files without the header are read in the old '%-15s %s' format of
+    'ip dd/mm/yy HH:MM' lines and written back in the new one.
+    """
+
+    HEADER = '# ban ledger v2\n'
+
+    def __init__(self):
+        self.bans = dict()
+        self.heap = []
+
+    def __contains__(self, ip):
+        return ip in self.bans
 
-        rule_num = rule['RuleNumber']
-        rule_ip = rule['CidrBlock'].split('/')[0]
-        if rule_ip in ips:
-            print 'Removed ' + rule_ip + '/32 from NACL.'
-            ec2.delete_network_acl_entry(
-               Egress=False,
-               NetworkAclId=NACL_ID,
-               RuleNumber=rule_num
-            )
-            rule_deleted.append(rule_num)
+    def __len__(self):
+        return len(self.bans)
 
-    return rule_deleted
+    def __iter__(self):
+        return iter(self.bans)
+
+    @staticmethod
+    def expiry(banned_at):
+        """Return the ordinal of the day a ban made at 'banned_at' expires."""
+        return date.fromtimestamp(banned_at).toordinal() + REMOVE_AFTER + 1
+
+    def ban(self, ip, banned_at, rule=None):
+        """Ban 'ip' at 'banned_at' epoch time."""
+        self.bans[ip] = (banned_at, rule)
+        heapq.heappush(self.heap, (self.expiry(banned_at), ip, banned_at))
+
+    def expire(self, today):
+        """Remove and return IPs banned longer than REMOVE_AFTER days."""
+        day = today.toordinal()
+        expired = []
+        while self.heap and self.heap[0][0] <= day:
+            _, ip, banned_at = heapq.heappop(self.heap)
+            ban = self.bans.get(ip)
+            if ban is not None and ban[0] == banned_at:
+                del self.bans[ip]
+                expired.append(ip)
+        return expired
+
+    def rules(self):
+        """Return the set of NACL rule numbers recorded for bans."""
+        return set(rule for _, rule in self.bans.itervalues()
+                   if rule is not None)
+
+    def assign_rules(self, rules):
+        """Record NACL rules, given as a map of CIDR block -> rule number."""
+        blocks = sorted((ip_to_int(cidr.split('/')[0]),
+                         int(cidr.split('/')[1]), rule)
+                        for cidr, rule in rules.items())
+        starts = [b[0] for b in blocks]
+        for ip, (banned_at, _) in self.bans.items():
+            n = ip_to_int(ip)
+            k = bisect.bisect_right(starts, n) - 1
+            rule = None
+            if n is not None and k >= 0:
+                start, prefix_len, block_rule = blocks[k]
+                if n - start < 2 ** (32 - prefix_len):
+                    rule = block_rule
+            self.bans[ip] = (banned_at, rule)
+
+    def dump(self, ledger_file):
+        """Write the ledger to 'ledger_file'."""
+        ledger_file.write(self.HEADER)
+        # sorted, so that an unchanged ledger is written the same
+        for ip in sorted(self.bans):
+            banned_at, rule = self.bans[ip]
+            ledger_file.write('%s %d %s\n' % (
+                ip, banned_at, '-' if rule is None else rule))
+
+    @classmethod
+    def load(cls, ledger_file):
+        """Return the ledger read from 'ledger_file'."""
+        ledger = cls()
+        lines = iter(ledger_file)
+        first = next(lines, cls.HEADER)
+        if first == cls.HEADER:
+            for line in lines:
+                ip, banned_at, rule = line.split()
+                ledger.bans[ip] = (int(banned_at),
+                                   None if rule == '-' else int(rule))
+        else:
+            for line in itertools.chain([first], lines):
+                fields = line.split()
+                if not fields:
+                    continue
+                banned_at = datetime.strptime(
+                    ' '.join(fields[1:3]),
+                    '%d/%m/%y %H:%M' if len(fields) > 2 else '%d/%m/%y')
+                ledger.bans[fields[0]] = (
+                    int(time.mktime(banned_at.timetuple())), None)
+        ledger.heap = [(cls.expiry(banned_at), ip, banned_at)
+                       for ip, (banned_at, _) in ledger.bans.iteritems()]
+        heapq.heapify(ledger.heap)
+        return ledger
+
+
+# Ledger saved by the last invocation of a warm container, with the ETag and
+# MD5 digest of its S3 object.
+LEDGER = dict()
+
+
+def fetch_ledger(s3):
+    """
+    Return (ledger, ETag, digest) of the ban ledger in S3.
+
+    The ledger cached by the previous invocation is reused if its object has
+    not been modified since. ETag and digest are None if there is no ledger.
+    """
+    cached = LEDGER.copy()
+    # the ledger is modified by this invocation, it is cached again once saved
+    LEDGER.clear()
+    params = dict(Bucket=S3_BUCKET_NAME, Key=LOG_FILE)
+    if cached:
+        params['IfNoneMatch'] = cached['etag']
+    try:
+        obj = s3.get_object(**params)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            print 'Ledger not modified, using the cached copy.'
+            return cached['ledger'], cached['etag'], cached['digest']
+        if code not in ('404', 'NoSuchKey'):
+            raise
+        print 'No ledger in S3, starting a new one.'
+        return BanLedger(), None, None
+    body = obj['Body'].read()
+    return (BanLedger.load(StringIO(body)), obj['ETag'],
+            hashlib.md5(body).hexdigest())
+
+
+def get_ledger_etag(s3):
+    """Return the ETag of the ledger in S3, None if there is no ledger."""
+    try:
+        return s3.head_object(Bucket=S3_BUCKET_NAME, Key=LOG_FILE)['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        return None
+
+
+def acquire_ledger_lock(dynamodb):
+    """
+    Take the lock of the ledger in LEDGER_LOCK_TABLE.
+
+    A lock not released by a crashed invocation is taken over once it
+    expires. Return the expiry of the lock taken, None if it is still held
+    by another invocation after LEDGER_LOCK_TIMEOUT seconds.
+    """
+    deadline = time.time() + LEDGER_LOCK_TIMEOUT
+    while True:
+        now = int(time.time())
+        expires = str(now + LEDGER_LOCK_TTL)
+        try:
+            dynamodb.put_item(
+                TableName=LEDGER_LOCK_TABLE,
+                Item={'ledger': {'S': LOG_FILE}, 'expires': {'N': expires}},
+                ConditionExpression='attribute_not_exists(ledger) OR '
+                                    'expires < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}})
+            return expires
+        except ClientError as e:
+            if e.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+        if time.time() >= deadline:
+            return None
+        time.sleep(LEDGER_LOCK_POLL_DELAY)
+
+
+def release_ledger_lock(dynamodb, expires):
+    """Release the lock of the ledger taken with expiry 'expires'."""
+    try:
+        dynamodb.delete_item(
+            TableName=LEDGER_LOCK_TABLE,
+            Key={'ledger': {'S': LOG_FILE}},
+            ConditionExpression='expires = :expires',
+            ExpressionAttributeValues={':expires': {'N': expires}})
+    except ClientError as e:
+        # the lock expired and was taken over, it is not ours to release
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def store_ledger(s3, ledger, etag, digest):
+    """
+    Upload 'ledger' to S3 if it differs from the object it was read from.
+
+    The upload only happens if the object still has 'etag', or still does
+    not exist, so bans saved by an overlapping invocation are not lost.
+    Without LEDGER_LOCK_TABLE, an invocation saving between the check and
+    the upload still goes unnoticed. Return False if the object was
+    modified in the meantime, or the lock could not be taken.
+    """
+    out = StringIO()
+    ledger.dump(out)
+    body = out.getvalue()
+    new_digest = hashlib.md5(body).hexdigest()
+    if new_digest == digest:
+        print 'Ledger not changed.'
+    else:
+        # conditional puts need a botocore that does not run on Python 2
+        dynamodb = dynamodb_connect() if LEDGER_LOCK_TABLE else None
+        lock = dynamodb and acquire_ledger_lock(dynamodb)
+        if dynamodb and lock is None:
+            print 'Ledger locked by another invocation.'
+            return False
+        try:
+            if get_ledger_etag(s3) != etag:
+                return False
+            etag = s3.put_object(Bucket=S3_BUCKET_NAME, Key=LOG_FILE,
+                                 Body=body)['ETag']
+        finally:
+            if lock:
+                release_ledger_lock(dynamodb, lock)
+    LEDGER.update(ledger=ledger, etag=etag, digest=new_digest)
+    return True
+
+
+def deny_entry(cidr, rule_num):
+    """Return parameters of the ingress deny rule 'rule_num' for 'cidr'."""
+    return dict(
+        CidrBlock=cidr,
+        Egress=False,
+        Protocol='-1',
+        NetworkAclId=NACL_ID,
+        PortRange={'From': 0, 'To': 65535},
+        RuleAction='deny',
+        RuleNumber=rule_num
+    )
+
+
+def update_rules(ec2, acl, blocks, owned, rule_numbers):
+    """
+    Reconcile 'owned' ban rules of the NACL with deny rules for 'blocks'.
+
+    Only blocks that changed are touched: a rule of a block no longer banned
+    is replaced in place by a rule of a new block, the rest of them are
+    deleted, and the remaining new blocks are created in free rule numbers.
+    New rules only take 'rule_numbers', older rules outside are deleted.
+    The calls are independent and made by NACL_MAX_WORKERS threads. A call
+    that fails is reported and the others still go ahead.
+
+    Return the map of CIDR block -> rule number of the ban rules in the NACL
+    after the calls that succeeded.
+    """
+    ban_rules = get_ban_rules(acl, owned)
+    blocks = set(blocks)
+    removed = sorted((rule_num, cidr) for cidr, rule_num in ban_rules.items()
+                     if cidr not in blocks)
+    reused = [rule for rule in removed if rule[0] in rule_numbers]
+    removed = [rule for rule in removed if rule[0] not in rule_numbers]
+    free_rules = get_free_rules_number(acl, rule_numbers)
+
+    # (method, parameters, message, CIDR block added, CIDR block removed)
+    calls = []
+    for cidr in sorted(blocks.difference(ban_rules)):
+        if reused:
+            rule_num, old_cidr = reused.pop()
+            calls.append((ec2.replace_network_acl_entry,
+                          deny_entry(cidr, rule_num),
+                          'Replaced %s with %s in NACL.' % (old_cidr, cidr),
+                          cidr, old_cidr))
+        elif free_rules:
+            rule_num = free_rules.pop()
+            calls.append((ec2.create_network_acl_entry,
+                          deny_entry(cidr, rule_num),
+                          'Added %s to NACL.' % cidr, cidr, None))
+        else:
+            print 'No free NACL rule for %s!' % cidr
+    for rule_num, cidr in removed + reused:
+        calls.append((ec2.delete_network_acl_entry,
+                      dict(Egress=False, NetworkAclId=NACL_ID,
+                           RuleNumber=rule_num),
+                      'Removed %s from NACL.' % cidr, None, cidr))
+
+    def call_safely(call):
+        """Make 'call', return the error it failed with or None."""
+        try:
+            call[0](**call[1])
+        except Exception as e:
+            return e
+        return None
+
+    errors = []
+    if calls:
+        pool = ThreadPool(min(NACL_MAX_WORKERS, len(calls)))
+        try:
+            errors = pool.map(call_safely, calls)
+        finally:
+            pool.close()
+            pool.join()
+    failed = 0
+    for (_, params, message, added, removed_cidr), error in zip(calls,
+                                                                errors):
+        if error is not None:
+            print 'error: not done: %s %s' % (message, error)
+            failed += 1
+            continue
+        print message
+        if removed_cidr is not None:
+            del ban_rules[removed_cidr]
+        if added is not None:
+            ban_rules[added] = params['RuleNumber']
+    print 'NACL: %d calls, %d failed, for %d ban rules.' % (
+        len(calls), failed, len(ban_rules))
+
+    return ban_rules
+
+
+class NaclBackend(object):
+    """
+    Ban rules of the NACL_ID network ACL, one rule per block.
+
+    Deny rules numbered within NACL_RULE_RANGE are bans, and older ones of
+    the ledger outside of it. Other rules are never changed.
+    """
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.rule_numbers = get_rule_numbers()
+        self.acl = None
+        self.owned = set()
+
+    def refresh(self, ledger=None):
+        """Read the current rules of the NACL, and those of 'ledger'."""
+        self.acl = self.ec2.describe_network_acls(Filters=NACL_FILTER)
+        self.owned.update(get_owned_rules(
+            self.acl, ledger or BanLedger(), self.rule_numbers))
+
+    def capacity(self):
+        """Return how many blocks can be banned."""
+        return get_rules_limit(self.acl, self.owned, self.rule_numbers)
+
+    def enforce(self, blocks):
+        """Ban 'blocks', return the map of CIDR block -> rule number."""
+        rules = update_rules(self.ec2, self.acl, blocks, self.owned,
+                             self.rule_numbers)
+        self.owned.update(rules.values())
+        return rules
+
+
+class WafIpSetBackend(object):
+    """
+    Addresses of the WAF_IP_SET_ID WAFv2 IP set.
+
+    All adds and removes of a run are made by a single update of the set.
+    """
+
+    def __init__(self, wafv2):
+        self.wafv2 = wafv2
+        self.ip_set = dict(Name=WAF_IP_SET_NAME, Scope=WAF_SCOPE,
+                           Id=WAF_IP_SET_ID)
+        self.addresses = set()
+        self.lock_token = None
+
+    def refresh(self, ledger=None):
+        """Read the current addresses of the IP set, all of them bans."""
+        response = self.wafv2.get_ip_set(**self.ip_set)
+        self.addresses = set(response['IPSet']['Addresses'])
+        self.lock_token = response['LockToken']
+
+    def capacity(self):
+        """Return how many blocks can be banned."""
+        return WAF_IP_SET_CAPACITY
+
+    def enforce(self, blocks):
+        """Ban 'blocks', return the map of CIDR block -> None."""
+        blocks = set(blocks)
+        for attempt in range(1, WAF_MAX_ATTEMPTS + 1):
+            added = blocks - self.addresses
+            removed = self.addresses - blocks
+            if not added and not removed:
+                break
+            try:
+                self.lock_token = self.wafv2.update_ip_set(
+                    Addresses=sorted(blocks), LockToken=self.lock_token,
+                    **self.ip_set)['NextLockToken']
+            except ClientError as e:
+                if (e.response['Error']['Code'] !=
+                        'WAFOptimisticLockException' or
+                        attempt == WAF_MAX_ATTEMPTS):
+                    raise
+                # modified since it was read, replace the newer version
+                print 'IP set modified meanwhile, updating again.'
+                self.refresh()
+                continue
+            self.addresses = blocks
+            break
+        print 'IP set: %d blocks added, %d removed.' % (len(added),
+                                                         len(removed))
+        return dict.fromkeys(blocks)
+
+
+class PrefixListBackend(object):
+    """
+    Entries of the PREFIX_LIST_ID EC2 managed prefix list.
+
+    Adds and removes of a run are batched into modifications of up to
+    PREFIX_LIST_CHUNK_SIZE entries each, every one of which must complete
+    before the next.
+    """
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self.prefix_list = None
+        self.entries = set()
+
+    def describe(self):
+        """Return the prefix list."""
+        return self.ec2.describe_managed_prefix_lists(
+            PrefixListIds=[PREFIX_LIST_ID])['PrefixLists'][0]
+
+    def refresh(self, ledger=None):
+        """Read the current entries of the prefix list, all of them bans."""
+        self.prefix_list = self.wait()
+        paginator = self.ec2.get_paginator('get_managed_prefix_list_entries')
+        self.entries = set(entry['Cidr']
+                           for page in paginator.paginate(
+                               PrefixListId=PREFIX_LIST_ID)
+                           for entry in page.get('Entries', []))
+
+    def wait(self):
+        """Return the prefix list once no operation is in progress on it."""
+        deadline = time.time() + PREFIX_LIST_TIMEOUT
+        while True:
+            prefix_list = self.describe()
+            state = prefix_list['State']
+            if state.endswith('-failed'):
+                raise RuntimeError('Prefix list %s is %s: %s' % (
+                    PREFIX_LIST_ID, state,
+                    prefix_list.get('StateMessage', '')))
+            if not state.endswith('-in-progress'):
+                return prefix_list
+            if time.time() > deadline:
+                raise RuntimeError('Prefix list %s still %s after %ds' % (
+                    PREFIX_LIST_ID, state, PREFIX_LIST_TIMEOUT))
+            time.sleep(PREFIX_LIST_POLL_DELAY)
+
+    def capacity(self):
+        """Return how many blocks can be banned."""
+        return self.prefix_list['MaxEntries']
+
+    def enforce(self, blocks):
+        """Ban 'blocks', return the map of CIDR block -> None."""
+        added = sorted(set(blocks) - self.entries)
+        removed = sorted(self.entries - set(blocks))
+        print 'Prefix list: %d blocks added, %d removed.' % (len(added),
+                                                              len(removed))
+        while added or removed:
+            remove = removed[:PREFIX_LIST_CHUNK_SIZE]
+            # removes go first, so that the list never exceeds MaxEntries
+            room = self.capacity() - len(self.entries) + len(remove)
+            add = added[:max(0, min(PREFIX_LIST_CHUNK_SIZE, room))]
+            params = dict(PrefixListId=PREFIX_LIST_ID,
+                          CurrentVersion=self.prefix_list['Version'])
+            if remove:
+                params['RemoveEntries'] = [{'Cidr': cidr} for cidr in remove]
+            if add:
+                params['AddEntries'] = [{'Cidr': cidr,
+                                         'Description': BAN_DESCRIPTION}
+                                        for cidr in add]
+            self.ec2.modify_managed_prefix_list(**params)
+            self.entries.difference_update(remove)
+            self.entries.update(add)
+            del removed[:len(remove)]
+            del added[:len(add)]
+            self.prefix_list = self.wait()
+        return dict.fromkeys(blocks)
+
+
+def get_backend():
+    """Return the ban backend selected by BAN_BACKEND."""
+    if BAN_BACKEND == 'nacl':
+        return NaclBackend(ec2_connect())
+    if BAN_BACKEND == 'waf':
+        return WafIpSetBackend(wafv2_connect())
+    if BAN_BACKEND == 'prefix-list':
+        return PrefixListBackend(ec2_connect())
+    raise ValueError('Unknown BAN_BACKEND: %s' % BAN_BACKEND)
 
 
 def lambda_handler(event, context):
     """Handler for a lambda funcion."""
-    global LOG_FILE_DATA
-    ec2 = ec2_connect()
+    global COLD_START
+    setup_start = time.time()
+    backend = get_backend()
     s3 = s3_connect()
+    print 'Setup: %.3fs%s' % (
+        time.time() - setup_start,
+        ', cold start, import: %.3fs' % IMPORT_TIME if COLD_START else '')
+    COLD_START = False
     today = datetime.now().strftime("%d/%m/%y %H:%M")
 
-    request = Request(ENDPOINT + API_URL)
-    request.add_header('Authorization', 'Basic %s' % TOKEN_B64)
-    data = {}
-    s3.download_file(S3_BUCKET_NAME, LOG_FILE, LOG_FILE_DIR + LOG_FILE)
-    nacl = ec2.describe_network_acls(Filters=NACL_FILTER)
-    ips_to_remove = get_ips_to_remove()
-    deleted = delete_rules(ec2, ips_to_remove, nacl)
-    free_rules = get_free_rules_number(nacl, deleted)
-    blocked_ips = get_blocked_ips(nacl, ips_to_remove)
+    ledger, etag, digest = fetch_ledger(s3)
+    # rules of bans about to expire are owned as well
+    backend.refresh(ledger)
+    ips_to_remove = ledger.expire(date.today())
+    if ips_to_remove:
+        print 'Unbanned: ' + ', '.join(ips_to_remove)
+    now = int(time.time())
+    banned = []
 
     try:
-        response = urlopen(request)
-        data = json.load(response)
+        for ip, count in find_bad_ips():
+            if ip in ledger:
+                print ip + ' already blocked!'
+            else:
+                print 'Added %-15s %s' % (ip, today)
+                ledger.ban(ip, now)
+                banned.append(ip)
     except URLError, e:
         print 'error: ', e
+    except (ValueError, socket.error), e:
+        print 'error: invalid response: ', e
+    except ClientError, e:
+        print 'error: ', e
+
+    for _ in range(LEDGER_MAX_ATTEMPTS):
+        # the ledger keeps single IPs, the backend as few blocks as possible
+        ledger.assign_rules(backend.enforce(
+            aggregate(ledger, backend.capacity())))
+        if store_ledger(s3, ledger, etag, digest):
+            break
+        # bans of the other invocation must stay in the backend as well
+        print 'Ledger modified by another invocation, merging.'
+        ledger, etag, digest = fetch_ledger(s3)
+        backend.refresh(ledger)
+        ledger.expire(date.today())
+        for ip in banned:
+            if ip not in ledger:
+                ledger.ban(ip, now)
+    else:
+        print 'error: ledger not saved, %d new bans not recorded!' % len(banned)
 
-    if data:
-        for ip, count in data['result']['terms'].items():
-            if count > HIT_COUNT:
-                if ip in blocked_ips:
-                    print ip + ' already blocked!'
-                else:
-                    response = ec2.create_network_acl_entry(
-                        CidrBlock=ip+'/32',
-                        Egress=False,
-                        Protocol='-1',
-                        NetworkAclId=NACL_ID,
-                        PortRange={'From': 0, 'To': 65535},
-                        RuleAction='deny',
-                        RuleNumber=free_rules.pop()
-                    )
-                    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                        print 'Added %-15s %s' % (ip, today)
-                        LOG_FILE_DATA.append('%-15s %s\n' % (ip, today))
-
-    with open(LOG_FILE_DIR + LOG_FILE, 'w') as bad_ips_file:
-        for line in LOG_FILE_DATA:
-            bad_ips_file.write("%s" % line)
-    s3.upload_file(LOG_FILE_DIR + LOG_FILE, S3_BUCKET_NAME, LOG_FILE)
 
+# Time spent importing this module, reported by the first invocation.
+IMPORT_TIME = time.time() - IMPORT_START
+COLD_START = True
 
 # lambda_handler(None, None)
@@ -1,4 +1,19 @@
 #!/usr/bin/env python
+"""
+AWS-List-inactive-users.py - list IAM users that are disabled or inactive.
+
+The audit can be used as a library: load this file with imp.load_source, get
+records of all users with iter_report_users() or iter_api_users() for an IAM
+client from iam_client(session), and pass them to iter_audit(), which yields
+a row for every user in the selected modes as soon as the user is processed.
+iter_accounts_audit() does the same for several accounts at once, through
+roles assumed in each of them. Nothing is done at import time.
+
+iter_incremental_users() is the incremental version of iter_api_users(): it
+keeps a snapshot of every user in SQLite, and only queries IAM for users
+whose console password or access keys changed since the last run. The rest
+are answered from the credential report and list_users.
+"""
 
 __author__ = "Lukasz Bytnar"
 __copyright__ = "Copyright 2018"
@@ -8,135 +23,507 @@ __email__ = ""
 __status__ = "Development"
 
 
-import boto3
-from datetime import datetime
-from botocore.exceptions import ClientError
+import csv
+import hashlib
+import json
+import Queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
 from datetime import timedelta, datetime
+# strptime imports this lazily, which is not thread safe on Python 2
+import _strptime  # noqa: F401
+from multiprocessing.pool import ThreadPool
 import argparse
 
 
+# Users audited at once through the API, and the sustained rate and burst of
+# IAM calls they share, below the rate at which IAM starts throttling.
+MAX_WORKERS = 10
+IAM_CALLS_PER_SECOND = 10
+IAM_CALLS_BURST = 20
+
+DATE_FORMAT = '%d-%m-%Y %H:%M:%S+00:00'
+# Dates in the credential report, without the always UTC offset.
+REPORT_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+REPORT_POLL_DELAY = 2
+# Columns of the credential report that change with the console password or
+# access keys of a user, but not with their use.
+REPORT_CHANGE_FIELDS = ['arn', 'user_creation_time', 'password_enabled',
+                        'password_last_changed', 'access_key_1_active',
+                        'access_key_1_last_rotated', 'access_key_2_active',
+                        'access_key_2_last_rotated']
+# Accounts audited at once, the session name of roles assumed in them, and
+# rows of all accounts buffered before the slowest reader blocks them.
+ACCOUNT_WORKERS = 16
+ROLE_SESSION_NAME = 'list-inactive-users'
+ROW_QUEUE_SIZE = 1000
+# Users not active for longer are inactive.
+CHECK_PERIOD = timedelta(days=90)
 
-iam = boto3.resource('iam')
-iam2 = boto3.client('iam')
+# Snapshot of users kept by incremental audits, per account, with the digest
+# of their REPORT_CHANGE_FIELDS, and how long to wait for another account's
+# audit writing to it.
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    account_id TEXT NOT NULL, user_name TEXT NOT NULL, row_digest TEXT NOT NULL,
+    checked_at TIMESTAMP NOT NULL, password_enabled INTEGER NOT NULL,
+    password_last_used TIMESTAMP, PRIMARY KEY (account_id, user_name));
+CREATE TABLE IF NOT EXISTS access_keys (
+    account_id TEXT NOT NULL, user_name TEXT NOT NULL, slot INTEGER NOT NULL,
+    active INTEGER NOT NULL, last_used TIMESTAMP,
+    PRIMARY KEY (account_id, user_name, slot));
+CREATE TABLE IF NOT EXISTS meta (
+    account_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT,
+    PRIMARY KEY (account_id, key));
+"""
+STATE_LOCK_TIMEOUT = 60
 
-all_users = iam.users.all()
+# Modes in the order they are printed, with the date shown by --verbose.
+MODES = [
+    ('no_console', None),
+    ('no_recent_activity', 'password_last_used'),
+    ('disabled', None),
+    ('last_active', 'last_activity'),
+]
+# Columns of the ndjson and csv output, account_id only with several accounts.
+FIELDS = ['account_id', 'user_name', 'modes', 'password_days', 'activity_days']
 
-# print dir(iam.users)
-DATE_FORMAT = '%d-%m-%Y %H:%M:%S+00:00'
-now = datetime.now()
-check_period = timedelta(days=90)
-policy_time = now - check_period
+class UserRecord(namedtuple('UserRecord', ['user_name', 'password_enabled',
+                                           'password_last_used', 'keys'])):
+    # everything the modes need about a user, 'keys' holds (active, last used)
+    # of each access key
+    __slots__ = ()
+
+    @property
+    def has_active_key(self):
+        return any(active for active, _ in self.keys)
+
+    @property
+    def last_activity(self):
+        dates = [used for _, used in self.keys if used is not None]
+        if self.password_last_used is not None:
+            dates.append(self.password_last_used)
+        return max(dates) if dates else None
+
+def iam_client(session=None, workers=MAX_WORKERS):
+    # boto3 is imported on first use, so that importing this file and --help
+    # stay fast
+    import boto3
+    from botocore.config import Config
+    session = session or boto3.Session()
+    return session.client('iam', config=Config(
+        retries={'mode': 'adaptive', 'max_attempts': 10},
+        max_pool_connections=workers))
+
+def parse_report_date(value):
+    # 'N/A', 'no_information' and the like mean never
+    try:
+        return datetime.strptime(value[:19], REPORT_DATE_FORMAT)
+    except ValueError:
+        return None
+
+def iter_report_rows(iam, poll_delay=REPORT_POLL_DELAY):
+    # one download of the report answers every question about every user,
+    # instead of several IAM calls per user and key; every record comes with
+    # a digest of its REPORT_CHANGE_FIELDS
+    while iam.generate_credential_report()['State'] != 'COMPLETE':
+        time.sleep(poll_delay)
+    content = iam.get_credential_report()['Content']
+    reader = csv.DictReader(content.splitlines())
+    for row in reader:
+        if row['user'] == '<root_account>':
+            continue
+        digest = hashlib.md5(','.join(row[field]
+                                      for field in REPORT_CHANGE_FIELDS))
+        yield UserRecord(
+            row['user'],
+            row['password_enabled'] == 'true',
+            parse_report_date(row['password_last_used']),
+            tuple((row['access_key_%d_active' % n] == 'true',
+                   parse_report_date(row['access_key_%d_last_used_date' % n]))
+                  for n in (1, 2))), digest.hexdigest()
+
+def iter_report_users(iam, poll_delay=REPORT_POLL_DELAY):
+    for record, _ in iter_report_rows(iam, poll_delay):
+        yield record
+
+class TokenBucket(object):
+    # at most 'rate' calls a second on average, 'burst' of them at once
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the token is taken now, callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(wait)
+
+def utc_date(date):
+    # API dates are UTC with a time zone, report dates are naive UTC
+    return date and date.replace(tzinfo=None)
+
+def get_user_record(iam, user, limiter):
+    # the same record as in the credential report, from 2 + keys calls
+    from botocore.exceptions import ClientError
+    name = user['UserName']
+    limiter.acquire()
+    try:
+        iam.get_login_profile(UserName=name)
+        password_enabled = True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        password_enabled = False
+    limiter.acquire()
+    keys = []
+    for key in iam.list_access_keys(UserName=name)['AccessKeyMetadata']:
+        limiter.acquire()
+        last_used = iam.get_access_key_last_used(
+            AccessKeyId=key['AccessKeyId'])['AccessKeyLastUsed']
+        keys.append((key['Status'] == 'Active',
+                     utc_date(last_used.get('LastUsedDate'))))
+    return UserRecord(name, password_enabled,
+                      utc_date(user.get('PasswordLastUsed')), tuple(keys))
+
+def iter_api_users(iam, workers=MAX_WORKERS, rate=IAM_CALLS_PER_SECOND):
+    # up to date records of all users, fetched concurrently and rate limited,
+    # in the order of list_users as soon as each one is ready
+    users = (user for page in iam.get_paginator('list_users').paginate()
+             for user in page['Users'])
+    limiter = TokenBucket(rate, IAM_CALLS_BURST)
+    pool = ThreadPool(workers)
+    try:
+        for record in pool.imap(
+                lambda user: get_user_record(iam, user, limiter), users):
+            yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+def open_state(path):
+    db = sqlite3.connect(path, timeout=STATE_LOCK_TIMEOUT,
+                         detect_types=sqlite3.PARSE_DECLTYPES)
+    db.text_factory = str
+    db.executescript(STATE_SCHEMA)
+    return db
+
+def load_state(db, account_id):
+    # user name -> (report row digest, checked at, record) of the snapshot
+    keys = dict()
+    for name, active, last_used in db.execute(
+            'SELECT user_name, active, last_used FROM access_keys '
+            'WHERE account_id = ? ORDER BY user_name, slot', (account_id,)):
+        keys.setdefault(name, []).append((bool(active), last_used))
+    return dict(
+        (name, (digest, checked_at,
+                UserRecord(name, bool(password_enabled), password_last_used,
+                           tuple(keys.get(name, ())))))
+        for name, digest, checked_at, password_enabled, password_last_used
+        in db.execute('SELECT user_name, row_digest, checked_at, '
+                      'password_enabled, password_last_used FROM users '
+                      'WHERE account_id = ?', (account_id,)))
+
+def save_state(db, account_id, updates, removed=()):
+    # one short transaction, so that audits of other accounts wait briefly
+    with db:
+        for digest, checked_at, record in updates:
+            db.execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)',
+                       (account_id, record.user_name, digest, checked_at,
+                        record.password_enabled, record.password_last_used))
+            db.execute('DELETE FROM access_keys WHERE account_id = ? AND '
+                       'user_name = ?', (account_id, record.user_name))
+            db.executemany('INSERT INTO access_keys VALUES (?, ?, ?, ?, ?)',
+                           [(account_id, record.user_name, slot, active, used)
+                            for slot, (active, used) in enumerate(record.keys)])
+        for name in removed:
+            db.execute('DELETE FROM users WHERE account_id = ? AND '
+                       'user_name = ?', (account_id, name))
+            db.execute('DELETE FROM access_keys WHERE account_id = ? AND '
+                       'user_name = ?', (account_id, name))
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)',
+                   (account_id, 'last_run', datetime.utcnow().isoformat()))
+
+def iter_incremental_users(iam, state_path, account_id='', workers=MAX_WORKERS,
+                           rate=IAM_CALLS_PER_SECOND, now=None):
+    # records of all users, like iter_api_users, but only users that are new
+    # or whose password or keys changed since the snapshot at 'state_path'
+    # are queried; the others are their credential report record with
+    # PasswordLastUsed of list_users, so dates of their keys are up to 4
+    # hours old
+    now = now or datetime.utcnow()
+    report = dict((record.user_name, (record, digest))
+                  for record, digest in iter_report_rows(iam))
+    db = open_state(state_path)
+    stored = load_state(db, account_id)
+    users = (user for page in iam.get_paginator('list_users').paginate()
+             for user in page['Users'])
+    limiter = TokenBucket(rate, IAM_CALLS_BURST)
+
+    def get_record(user):
+        # (report digest, record, whether it was queried) of 'user'
+        name = user['UserName']
+        record, digest = report.get(name, (None, ''))
+        old = stored.get(name)
+        # users created after the report are queried until they are in it
+        if record is None or old is None or old[0] != digest:
+            return digest, get_user_record(iam, user, limiter), True
+        return digest, record._replace(
+            password_last_used=utc_date(user.get('PasswordLastUsed'))), False
+
+    seen = set()
+    updates = []
+    queried = 0
+    complete = False
+    pool = ThreadPool(workers)
+    try:
+        for digest, record, fresh in pool.imap(get_record, users):
+            seen.add(record.user_name)
+            queried += fresh
+            old = stored.get(record.user_name)
+            if old is None or old[0] != digest or old[2] != record:
+                updates.append((digest, now, record))
+            yield record
+        complete = True
+        sys.stderr.write('%s%d users, %d queried\n' % (
+            account_id and account_id + ': ', len(seen), queried))
+    finally:
+        pool.terminate()
+        pool.join()
+        save_state(db, account_id, updates,
+                   set(stored) - seen if complete else ())
+        db.close()
 
-def user_lastused_pass(users, verbose=False):
-    noconsole_users = get_noconsole_users(users)
-    lastused = []
+def is_stale(date, policy_time):
+    return date is None or policy_time > date
+
+def days_since(date, now):
+    return -1 if date is None else (now - date).days
+
+def user_modes(user, policy_time):
+    # modes the user is listed in
+    modes = []
+    if not user.password_enabled:
+        modes.append('no_console')
+    elif is_stale(user.password_last_used, policy_time):
+        modes.append('no_recent_activity')
+    if not user.password_enabled and not user.has_active_key:
+        modes.append('disabled')
+    if is_stale(user.last_activity, policy_time):
+        modes.append('last_active')
+    return modes
+
+def iter_audit(users, modes=None, now=None, check_period=CHECK_PERIOD):
+    # a row for every user in any of 'modes' (all by default), inactive for
+    # longer than 'check_period' before 'now' (UTC)
+    now = now or datetime.utcnow()
+    policy_time = now - check_period
+    modes = set(modes or [mode for mode, _ in MODES])
     for user in users:
-        if user.user_name in noconsole_users:
+        matched = [mode for mode in user_modes(user, policy_time)
+                   if mode in modes]
+        if not matched:
             continue
-        if user.password_last_used == None:
-            if not verbose:
-                lastused.append(user.user_name)
+        yield {
+            'user_name': user.user_name,
+            'modes': matched,
+            'password_days': (days_since(user.password_last_used, now)
+                              if user.password_enabled else None),
+            'activity_days': days_since(user.last_activity, now),
+        }
+
+def iter_account_audit(session, modes=None, api=False,
+                       rate=IAM_CALLS_PER_SECOND, now=None, state_path=None,
+                       account_id='', check_period=CHECK_PERIOD):
+    # iter_audit rows of the account of 'session', with 'api' incremental
+    # over the snapshot at 'state_path'
+    if state_path and not api:
+        raise ValueError('state_path needs api')
+    iam = iam_client(session)
+    now = now or datetime.utcnow()
+    if state_path:
+        users = iter_incremental_users(iam, state_path, account_id, rate=rate,
+                                       now=now)
+    elif api:
+        users = iter_api_users(iam, rate=rate)
+    else:
+        users = iter_report_users(iam)
+    return iter_audit(users, modes, now, check_period)
+
+def role_account_id(role_arn):
+    # arn:aws:iam::<account id>:role/<name>
+    parts = role_arn.split(':')
+    if len(parts) != 6 or parts[0] != 'arn' or not parts[4].isdigit():
+        raise ValueError('invalid role ARN: ' + role_arn)
+    return parts[4]
+
+def assume_role_session(session, role_arn, session_name=ROLE_SESSION_NAME):
+    import boto3
+    credentials = session.client('sts').assume_role(
+        RoleArn=role_arn, RoleSessionName=session_name)['Credentials']
+    return boto3.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
+        region_name=session.region_name)
+
+def iter_accounts_audit(session, role_arns, modes=None, api=False,
+                        rate=IAM_CALLS_PER_SECOND, workers=ACCOUNT_WORKERS,
+                        now=None, state_path=None, check_period=CHECK_PERIOD):
+    # iter_audit rows of the accounts of 'role_arns', assumed with 'session',
+    # tagged with 'account_id' and merged as they come; every account has
+    # its own rate limit, and an account that fails is reported on stderr
+    now = now or datetime.utcnow()
+    rows = Queue.Queue(ROW_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                rows.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def audit_account(role_arn):
+        try:
+            account_id = role_account_id(role_arn)
+            account_session = assume_role_session(session, role_arn)
+            for row in iter_account_audit(account_session, modes, api, rate,
+                                          now, state_path, account_id,
+                                          check_period):
+                row['account_id'] = account_id
+                if not put((role_arn, row, None)):
+                    return
+        except Exception as e:
+            put((role_arn, None, e))
+        finally:
+            put((role_arn, None, None))
+
+    if state_path:
+        # create the snapshot before accounts race to do it
+        open_state(state_path).close()
+    pool = ThreadPool(max(1, min(workers, len(role_arns))))
+    try:
+        for role_arn in role_arns:
+            pool.apply_async(audit_account, (role_arn,))
+        pending = len(role_arns)
+        while pending:
+            role_arn, row, error = rows.get()
+            if error is not None:
+                sys.stderr.write('%s: %s\n' % (role_arn, error))
+            elif row is None:
+                pending -= 1
             else:
-                lastused.append((user.user_name, -1))
+                yield row
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+def row_label(row):
+    if 'account_id' in row:
+        return row['account_id'] + ' ' + row['user_name']
+    return row['user_name']
+
+def audit(rows):
+    # labels of users of every mode and rows by label, from iter_audit rows
+    report = dict((mode, set()) for mode, _ in MODES)
+    by_label = dict()
+    for row in rows:
+        for mode in row['modes']:
+            report[mode].add(row_label(row))
+        by_label[row_label(row)] = row
+    return report, by_label
+
+def write_ndjson(rows, out):
+    for row in rows:
+        out.write(json.dumps(row, sort_keys=True) + '\n')
+        out.flush()
+
+def write_csv(rows, out):
+    writer = csv.DictWriter(out, FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(dict(row, modes=' '.join(row['modes'])))
+        out.flush()
+
+def write_text(rows, out, selected, verbose=False):
+    # sections by mode, so all users are collected first
+    report, by_label = audit(rows)
+    day_fields = {'password_last_used': 'password_days',
+                  'last_activity': 'activity_days'}
+    for mode, date in MODES:
+        if mode not in selected:
             continue
-        if policy_time > user.password_last_used.replace(tzinfo=None):
-            if not verbose:
-                lastused.append(user.user_name)
+        if len(selected) > 1:
+            out.write('# ' + mode.replace('_', '-') + '\n')
+        for label in sorted(report[mode]):
+            if verbose and date:
+                out.write(label + ' (' + str(by_label[label][day_fields[date]]) + ' days)\n')
             else:
-                lastused.append((user.user_name, (now - user.password_last_used.replace(tzinfo=None)).days))
-    return lastused
+                out.write(label + '\n')
 
-def check_user_keys(users, verbose=False):
-    lastkeys = []
-    for user in users:
-        user_keys = iam2.list_access_keys(UserName=user.user_name)['AccessKeyMetadata']
-        if len(user_keys) > 0:
-            print user_keys
-            for key in user_keys:
-                if key['Status'] == 'Active':
-                    key_data = iam2.get_access_key_last_used(AccessKeyId=key['AccessKeyId'])
-                    print key_data
-                    if policy_time > key_data['AccessKeyLastUsed']['LastUsedDate'].replace(tzinfo=None):
-                        if not verbose:
-                            lastkeys.append(user.user_name)
-                        else:
-                            lastkeys.append((user.user_name, (policy_time - key_data['AccessKeyLastUsed']['LastUsedDate'].replace(tzinfo=None)).days))
-    return lastkeys
-
-def is_user_active_key(username):
-        user_keys = iam2.list_access_keys(UserName=username)['AccessKeyMetadata']
-        if len(user_keys) > 0:
-            for key in user_keys:
-                if key['Status'] == 'Active':
-                    return True
-        else:
-            return False
-
-
-def get_noconsole_users(users):
-    noconsole_users = []
-    for user in users:
-        profile = user.LoginProfile()
-        try:
-            profile.load()
-        except ClientError:
-            noconsole_users.append(user.user_name)
-    return noconsole_users
+def main(argv=None, session=None, out=sys.stdout):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--no-console', help='show users with no console access', action='store_true')
+    parser.add_argument('-t', '--no-recent-activity', help='show users with last activity longer than 90 days', action='store_true')
+    parser.add_argument('-d', '--disabled', help='show users with no console login and no access key', action='store_true')
+    parser.add_argument('-l', '--last-active', help='show users that didnt use console or access key in last 90 days', action='store_true')
+    parser.add_argument('-v', '--verbose', help='show extra information', action='store_true')
+    parser.add_argument('-a', '--api', help='query IAM for every user instead of using the up to 4 hours old credential report', action='store_true')
+    parser.add_argument('-r', '--rate', help='IAM calls per second with --api', type=float, default=IAM_CALLS_PER_SECOND)
+    parser.add_argument('--role-arn', help='audit the account of this role instead, assumed with the default credentials; may be repeated', action='append', default=[])
+    parser.add_argument('--role-arns-file', help='file with a role ARN per line to audit')
+    parser.add_argument('-w', '--account-workers', help='accounts audited at once', type=int, default=ACCOUNT_WORKERS)
+    parser.add_argument('-s', '--state', help='SQLite snapshot of users for --api; query IAM only for users whose console password or access keys changed since the last run')
+    parser.add_argument('-o', '--output', help='text sections, or ndjson or csv rows streamed as users are processed', choices=['text', 'ndjson', 'csv'], default='text')
+    args = parser.parse_args(argv)
 
-def get_nokeys_users(users):
-    nokeys_users = []
-    for user in users:
-        if not is_user_active_key(user.user_name):
-            nokeys_users.append(user.user_name)
-    return nokeys_users
-
-def get_inactive_user(users):
-    console = get_noconsole_users(users)
-    keys = get_nokeys_users(users)
-    return [user for user in console if user in keys]
-
-def get_user_activity(users):
-    # console = user_lastused_pass(users)
-    keys = check_user_keys(users)
-    # print console
-    print keys
-    return []
-    # return [user for user in console if user in keys]
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-c', '--no-console', help='show users with no console access', action='store_true')
-parser.add_argument('-t', '--no-recent-activity', help='show users with last activity longer than 90 days', action='store_true')
-parser.add_argument('-d', '--disabled', help='show users with no console login and no access key', action='store_true')
-parser.add_argument('-l', '--last-active', help='show users that didnt use console or access key in last 90 days', action='store_true')
-parser.add_argument('-v', '--verbose', help='show extra information', action='store_true')
-args = parser.parse_args()
-if args.no_console:
-    print ("\n").join(get_noconsole_users(all_users))
-elif args.no_recent_activity:
-    if not args.verbose:
-        print ("\n").join(user_lastused_pass(all_users))
+    if args.state and not args.api:
+        parser.error('--state needs --api')
+    selected = [mode for mode, _ in MODES if getattr(args, mode)]
+    if not selected:
+        return
+    role_arns = list(args.role_arn)
+    if args.role_arns_file:
+        with open(args.role_arns_file) as role_arns_file:
+            role_arns.extend(line.strip() for line in role_arns_file
+                             if line.strip() and not line.startswith('#'))
+    for role_arn in role_arns:
+        try:
+            role_account_id(role_arn)
+        except ValueError as e:
+            parser.error(str(e))
+    if not session:
+        import boto3
+        session = boto3.Session()
+    if role_arns:
+        rows = iter_accounts_audit(session, role_arns, selected, args.api,
+                                   args.rate, args.account_workers,
+                                   state_path=args.state)
+    else:
+        rows = iter_account_audit(session, selected, args.api, args.rate,
+                                  state_path=args.state)
+    if args.output == 'ndjson':
+        write_ndjson(rows, out)
+    elif args.output == 'csv':
+        write_csv(rows, out)
     else:
-        print ("\n").join([user[0] + ' (' + str(user[1]) + ' days)' for user in user_lastused_pass(all_users, args.verbose)])
-        #print user_lastused_pass(all_users, args.verbose)
-elif args.disabled:
-    print ("\n").join(get_inactive_user(all_users))
-elif args.last_active:
-    print ("\n").join(get_user_activity(all_users))
-
-# for user in iam.users.all():
-#     # print user
-#     check_user_keys(user.user_name)
-#     profile = user.LoginProfile()
-#     try:
-#         profile.load()
-#     except ClientError as e:
-#         # print(e.__dict__)
-#         #print user.user_name, '(NO CONSOLE ACCESS)'
-#         continue
-#     # print profile
-#     if user.password_last_used is not None:
-#         if user_lastused_pass(user):
-#             # print dir(policy_time - user.password_last_used.replace(tzinfo=None))
-#             print user.user_name, (policy_time - user.password_last_used.replace(tzinfo=None)).days
-#             # print 'Last used: ', user.password_last_used
-#             # print 'Create_date: ', user.create_date
+        write_text(rows, out, selected, args.verbose)
+
+if __name__ == '__main__':
+    main()